@@ -3,32 +3,129 @@
 
 
 
-import os, shutil, hashlib, collections, re
+import os, hashlib, collections, re, time, random, tempfile, pickle, json, stat, struct, base64, logging, tarfile, zipfile
 from os.path import join, basename, dirname, abspath
 
 from zeroinstall.injector import model
 from zeroinstall import SafeException, support
 from zeroinstall.support import tasks
 
-from repo import paths, urltest
+from repo import paths, urltest, stats, cache
 
 valid_simple_name = re.compile(r'^[^. \n/][^ \n/]*$')
 
 class Archive(object):
-	def __init__(self, source_path, rel_url, size, incoming_path = None):
+	def __init__(self, source_path, rel_url, size, incoming_path = None, sha1 = None):
 		self.basename = basename(source_path)
 		self.source_path = source_path
 		self.rel_url = rel_url
 		self.size = size
 		self.incoming_path = incoming_path	# (used to delete from /incoming)
+		self.sha1 = sha1			# (if already known)
 
-def get_sha1(path):
+def _hash_file(path):
 	sha1 = hashlib.sha1()
 	with open(path, 'rb') as stream:
 		while True:
 			got = stream.read(4096)
 			if not got: break
 			sha1.update(got)
+			stats.count('bytes hashed', len(got))
+	return sha1.hexdigest()
+
+class HashCache(object):
+	"""The SHA-1s of files we have hashed before, keyed by (device, inode, size, mtime_ns), so that
+	unchanged files are never read twice. Each line of the file is 'DEVICE INODE SIZE MTIME_NS SHA1';
+	new entries are appended, replacing any earlier entry for the same file.
+	If verify_fraction is non-zero, that fraction of the cache hits are hashed again anyway, as a check."""
+	racy_seconds = 2	# Don't trust the mtime of files changed more recently than this
+
+	def __init__(self, path, verify_fraction = 0):
+		self.path = path
+		self.verify_fraction = verify_fraction
+		self.records = cache.RecordFile(path, 5)
+		self.entries = {}	# (device, inode) -> (size, mtime_ns, sha1)
+		lines = 0
+		for fields in self.records.read():
+			dev, ino, size, mtime = [int(x) for x in fields[:4]]
+			self.entries[(dev, ino)] = (size, mtime, fields[4])
+			lines += 1
+		if lines > 2 * len(self.entries) + 100:
+			self.save_all()		# Remove the replaced entries
+
+	def get_sha1(self, path):
+		info = os.stat(path)
+		cached = self.entries.get((info.st_dev, info.st_ino), None)
+		if cached is not None and cached[:2] == (info.st_size, info.st_mtime_ns):
+			if not (self.verify_fraction and random.random() < self.verify_fraction):
+				stats.count('hash cache hits')
+				return cached[2]
+			stats.count('hash cache entries verified')
+			sha1 = _hash_file(path)
+			if sha1 == cached[2]:
+				return sha1
+			print("Warning: {path} changed without its size or modification time changing (cached SHA-1 was {old}, but now it's {new})".format(
+				path = path, old = cached[2], new = sha1))
+		else:
+			sha1 = _hash_file(path)
+		if time.time() - info.st_mtime > self.racy_seconds:
+			self._add(info, sha1)
+		return sha1
+
+	def record(self, path, sha1):
+		"""Record the SHA-1 of a file we have just written."""
+		self._add(os.stat(path), sha1)
+
+	def _add(self, info, sha1):
+		self.entries[(info.st_dev, info.st_ino)] = (info.st_size, info.st_mtime_ns, sha1)
+		self.records.append([info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, sha1])
+
+	def save_all(self):
+		self.records.rewrite([dev, ino, size, mtime, sha1] for (dev, ino), (size, mtime, sha1) in sorted(self.entries.items()))
+
+def get_sha1(path, config = None):
+	"""The SHA-1 of the file at path, from config.hash_cache if it has an up-to-date entry."""
+	hash_cache = getattr(config, 'hash_cache', None)
+	if hash_cache is None:
+		return _hash_file(path)
+	return hash_cache.get_sha1(path)
+
+def link_or_copy(config, source_path, target_path):
+	"""Make target_path a copy of source_path and return its SHA-1.
+	If LINK_ARCHIVES is set (the default), source_path is in the repository's own 'incoming' directory
+	(which we delete it from afterwards) and the paths are on the same file system, target_path is just
+	a hard link to source_path. Otherwise, the data is hashed as it is copied. Either way, the archive
+	is only read once."""
+	if os.path.exists(target_path) and os.path.samefile(source_path, target_path):
+		return get_sha1(target_path, config)	# (already linked by an earlier attempt)
+	tmp_path = target_path + '.new'
+	if os.path.lexists(tmp_path):
+		os.unlink(tmp_path)
+	# (a file elsewhere, e.g. added with "0repo add", might be rebuilt in place, changing our "copy" too)
+	in_incoming = os.path.realpath(dirname(abspath(source_path))) == os.path.realpath('incoming')
+	if in_incoming and getattr(config, 'LINK_ARCHIVES', True):
+		try:
+			os.link(source_path, tmp_path)
+		except OSError:
+			pass		# (e.g. on a different file system)
+		else:
+			support.portable_rename(tmp_path, target_path)
+			stats.count('archives linked')
+			return get_sha1(target_path, config)
+	sha1 = hashlib.sha1()
+	with open(source_path, 'rb') as source:
+		with open(tmp_path, 'wb') as target:
+			while True:
+				got = source.read(1024 * 1024)
+				if not got: break
+				sha1.update(got)
+				target.write(got)
+				stats.count('bytes hashed', len(got))
+				stats.count('bytes copied', len(got))
+	support.portable_rename(tmp_path, target_path)
+	hash_cache = getattr(config, 'hash_cache', None)
+	if hash_cache is not None:
+		hash_cache.record(target_path, sha1.hexdigest())
 	return sha1.hexdigest()
 
 def _assert_identical_archives(name, sha1, existing):
@@ -43,72 +140,461 @@ def _default_archive_test(archive, url):
 		raise SafeException("Archive {url} has size {actual}, but expected {expected} bytes".format(
 				    url = url, actual = actual_size, expected = archive.size))
 
-def process_method(config, incoming_dir, impl, method, required_digest):
-	archives = []
-
+def _as_recipe(method):
 	if not isinstance(method, model.Recipe):
 		# turn an individual method into a single-step Recipe
 		step = method
 		method = model.Recipe()
 		method.steps.append(step)
+	return method
+
+def _find_incoming_archive(incoming_dir, archive):
+	if not valid_simple_name.match(archive):
+		raise SafeException("Illegal archive name '{name}'".format(name = archive))
+
+	archive_path = join(incoming_dir, archive)
+	if not os.path.isfile(archive_path):
+		raise SafeException("Referenced upload '{path}' not found".format(path = archive_path))
+	return archive_path
+
+def _should_check_digests(config):
+	return getattr(config, 'CHECK_DIGESTS', True) and os.name != 'nt'
+
+def _check_digest(config, impl, method, required_digest):
+	"""Check that the archives (whose URLs must now be local paths) unpack to give the correct digest."""
+	with stats.phase('incoming/digests'):
+		if getattr(config, 'STREAM_DIGESTS', True) and stream_digest_matches(method, required_digest):
+			stats.count('digests checked by streaming')
+			return
+		stats.count('digests checked by unpacking')
+		impl.feed.local_path = "/is-local-hack.xml"
+		try:
+			blocker = config.zconfig.fetcher.cook(required_digest, method,
+						config.zconfig.stores, impl_hint = impl, dry_run = True, may_use_mirror = False)
+			tasks.wait_for_blocker(blocker)
+		finally:
+			impl.feed.local_path = None
 
-	has_external_archives = False
-
-	for step in method.steps:
-		if not hasattr(step, 'url'): continue
-		archive = step.url
-
-		if '/' in archive:
-			has_external_archives = True
-			test_archive = getattr(config, 'check_external_archive', _default_archive_test)
-			test_archive(step, archive)
-			continue		# Hosted externally
-
-		if not valid_simple_name.match(archive):
-			raise SafeException("Illegal archive name '{name}'".format(name = archive))
-
-		archive_path = join(incoming_dir, archive)
-		if not os.path.isfile(archive_path):
-			raise SafeException("Referenced upload '{path}' not found".format(path = archive_path))
-
-		existing = config.archive_db.entries.get(archive, None)
-		if existing is not None:
-			new_sha1 = get_sha1(archive_path)
-			_assert_identical_archives(archive, sha1=new_sha1, existing=existing)
+# Calculating manifest digests by reading the archive directly, without unpacking it to disk.
+# This only ever confirms a digest: if the archive or recipe is unusual in any way, or the digest
+# doesn't match, _check_digest uses the fetcher instead (which also reports the error).
+
+class _Unsupported(Exception):
+	pass
+
+_stream_algorithms = {
+	'sha1new': hashlib.sha1,
+	'sha256': hashlib.sha256,
+	'sha256new': hashlib.sha256,
+}
+
+_archive_extensions = [
+	('.tar.gz', 'application/x-compressed-tar'),
+	('.tgz', 'application/x-compressed-tar'),
+	('.tar.bz2', 'application/x-bzip-compressed-tar'),
+	('.tar.xz', 'application/x-xz-compressed-tar'),
+	('.txz', 'application/x-xz-compressed-tar'),
+	('.tar', 'application/x-tar'),
+	('.zip', 'application/zip'),
+]
+
+_tar_modes = {
+	'application/x-tar': 'r:',
+	'application/x-compressed-tar': 'r:gz',
+	'application/x-bzip-compressed-tar': 'r:bz2',
+	'application/x-xz-compressed-tar': 'r:xz',
+}
+
+_DIR = 'D'
+
+def _format_digest(alg, digest):
+	if alg == 'sha256new':
+		return 'sha256new_' + base64.b32encode(digest).decode('ascii').rstrip('=')
+	return alg + '=' + digest.hex()
+
+def _split_path(name):
+	"""Split a path in an archive into its components, refusing anything that might be unpacked differently."""
+	if name.startswith('/'):
+		raise _Unsupported("absolute path " + name)
+	parts = tuple(part for part in name.split('/') if part not in ('', '.'))
+	if '..' in parts or any('\n' in part for part in parts):
+		raise _Unsupported("unsafe path " + name)
+	return parts
+
+def _hash_stream(stream, new_hash):
+	digest = new_hash()
+	size = 0
+	while True:
+		got = stream.read(1024 * 1024)
+		if not got: break
+		digest.update(got)
+		size += len(got)
+	stats.count('bytes hashed', size)
+	return digest.hexdigest(), size
+
+def _file_kind(mode, umask):
+	execute = mode & 0o111
+	if execute and not execute & ~umask:
+		raise _Unsupported("execute bits depend on the umask")
+	return 'X' if execute else 'F'
+
+def _symlink_entry(target, new_hash):
+	if not target.isascii():
+		raise _Unsupported("non-ASCII symlink target")
+	return ('S', new_hash(target.encode('ascii')).hexdigest(), len(target))
+
+def _read_tar(path, mime_type, new_hash, umask):
+	"""Yields (name, entry) for each member of a tarball."""
+	with tarfile.open(path, _tar_modes[mime_type]) as archive:
+		for member in archive:
+			if member.isdir():
+				yield member.name, _DIR
+			elif member.isreg() and not member.issparse():
+				digest, size = _hash_stream(archive.extractfile(member), new_hash)
+				yield member.name, (_file_kind(member.mode, umask), digest, int(member.mtime), size)
+			elif member.issym():
+				yield member.name, _symlink_entry(member.linkname, new_hash)
+			else:
+				raise _Unsupported("unsupported tar member type for " + member.name)
+
+def _zip_mtime(info):
+	"""The modification time from the zip entry's 'extended timestamp' field (which unzip uses).
+	Without it, the time depends on the time-zone."""
+	extra = info.extra
+	while len(extra) >= 4:
+		tag, size = struct.unpack('<HH', extra[:4])
+		if tag == 0x5455 and size >= 5 and extra[4] & 1:
+			return struct.unpack('<i', extra[5:9])[0]
+		extra = extra[4 + size:]
+	raise _Unsupported("no extended timestamp for " + info.filename)
+
+def _read_zip(path, new_hash, umask):
+	"""Yields (name, entry) for each member of a zip archive."""
+	with zipfile.ZipFile(path) as archive:
+		for info in archive.infolist():
+			if info.create_system != 3:
+				raise _Unsupported("permissions of " + info.filename + " aren't stored in Unix format")
+			mode = info.external_attr >> 16
+			if info.is_dir():
+				yield info.filename, _DIR
+			elif stat.S_ISLNK(mode):
+				yield info.filename, _symlink_entry(archive.read(info).decode('ascii'), new_hash)
+			elif stat.S_ISREG(mode):
+				with archive.open(info) as stream:
+					digest, size = _hash_stream(stream, new_hash)
+				yield info.filename, (_file_kind(mode, umask), digest, _zip_mtime(info), size)
+			else:
+				raise _Unsupported("unsupported zip member type for " + info.filename)
+
+def _add_to_tree(tree, parts, entry):
+	for i in range(1, len(parts)):
+		existing = tree.setdefault(parts[:i], _DIR)
+		if existing is not _DIR:
+			raise _Unsupported("{path} is both a file and a directory".format(path = '/'.join(parts[:i])))
+	existing = tree.get(parts, None)
+	if existing is not None and (existing is not _DIR or entry is not _DIR):
+		raise _Unsupported("{path} appears more than once".format(path = '/'.join(parts)))
+	tree[parts] = entry
+
+def _manifest_lines(tree):
+	"""The lines of the manifest for tree, in the order 0install generates them."""
+	children = collections.defaultdict(list)
+	for parts, entry in tree.items():
+		if parts:
+			children[parts[:-1]].append((parts[-1], entry))
+	def recurse(parts):
+		if parts:
+			yield 'D /' + '/'.join(parts)
+		dirs = []
+		for name, entry in sorted(children[parts], key = lambda child: child[0]):
+			if entry is _DIR:
+				dirs.append(name)
+			elif entry[0] == 'S':
+				yield 'S %s %d %s' % (entry[1], entry[2], name)
+			elif name != '.manifest':
+				yield '%s %s %d %d %s' % (entry[0], entry[1], entry[2], entry[3], name)
+		for name in dirs:
+			yield from recurse(parts + (name,))
+	return recurse(())
+
+def stream_manifest_digest(recipe, alg):
+	"""Calculate the manifest digest (using algorithm 'alg') of the tree that 'recipe' would produce,
+	by reading its archive directly. Raises _Unsupported unless the recipe is a single local
+	tar or zip archive without anything unusual in it."""
+	steps = recipe.steps
+	if len(steps) != 1 or not isinstance(steps[0], model.DownloadSource):
+		raise _Unsupported("not a single archive")
+	step = steps[0]
+	if getattr(step, 'start_offset', None):
+		raise _Unsupported("start-offset")
+	mime_type = getattr(step, 'type', None)
+	if not mime_type:
+		for extension, mime_type in _archive_extensions:
+			if step.url.endswith(extension):
+				break
 		else:
-			archive_rel_url = paths.get_archive_rel_url(config, archive, impl)
-
-			# Copy to archives directory
-
-			backup_dir = config.LOCAL_ARCHIVES_BACKUP_DIR	# note: may be relative; that's OK
-			backup_target_dir = join(backup_dir, dirname(archive_rel_url))
-			paths.ensure_dir(backup_target_dir)
-			copy_path = join(backup_dir, archive_rel_url)
-			shutil.copyfile(archive_path, copy_path)
-
-			stored_archive = Archive(abspath(copy_path), archive_rel_url, step.size, archive_path)
-			actual_size = os.path.getsize(stored_archive.source_path)
+			mime_type = None
+	new_hash = _stream_algorithms[alg]
+
+	umask = os.umask(0o22)
+	os.umask(umask)
+	if mime_type in _tar_modes:
+		members = _read_tar(step.url, mime_type, new_hash, umask)
+	elif mime_type == 'application/zip':
+		members = _read_zip(step.url, new_hash, umask)
+	else:
+		raise _Unsupported("archive type {type}".format(type = mime_type))
+
+	extract = _split_path(step.extract) if getattr(step, 'extract', None) else ()
+	dest = _split_path(step.dest) if getattr(step, 'dest', None) else ()
+	tree = {(): _DIR}
+	found_extract = not extract
+	for name, entry in members:
+		parts = _split_path(name)
+		if parts[:len(extract)] != extract:
+			continue
+		parts = parts[len(extract):]
+		if not parts and entry is not _DIR:
+			raise _Unsupported("extract is not a directory")
+		found_extract = True
+		_add_to_tree(tree, dest + parts, entry)
+	if not found_extract:
+		raise _Unsupported("extract directory not found")
+
+	digest = new_hash()
+	for line in _manifest_lines(tree):
+		digest.update((line + '\n').encode('utf-8'))
+	return _format_digest(alg, digest.digest())
+
+def stream_digest_matches(recipe, required_digest):
+	"""Whether we can confirm, without unpacking anything, that recipe gives required_digest.
+	False means we don't know (the fetcher must decide)."""
+	if '=' in required_digest:
+		alg = required_digest.split('=', 1)[0]
+	else:
+		alg = required_digest.split('_', 1)[0]
+	if alg not in _stream_algorithms:
+		return False
+	try:
+		actual = stream_manifest_digest(recipe, alg)
+	except Exception as ex:
+		# (_Unsupported, or any problem reading the archive, which the fetcher will report properly)
+		logging.info("Can't check digest by streaming (%s); unpacking instead", ex)
+		return False
+	if actual != required_digest:
+		logging.info("Streamed digest %s != %s; unpacking to check", actual, required_digest)
+		return False
+	return True
+
+class DigestCache(object):
+	"""Manifest digests we have already verified, keyed by IncomingMethod.get_digest_key (which covers
+	the contents of the archives and how they are unpacked), so that checking the same archives again
+	doesn't need them to be unpacked. Each line of the file is 'KEY DIGEST'; new entries are appended."""
+	def __init__(self, path):
+		self.records = cache.RecordFile(path, 2)
+		self.entries = set(tuple(fields) for fields in self.records.read())	# (key, digest)
+
+	def is_verified(self, key, digest):
+		return (key, digest) in self.entries
+
+	def add(self, key, digest):
+		if (key, digest) in self.entries:
+			return
+		self.entries.add((key, digest))
+		self.records.append([key, digest])
+
+# The attributes of the recipe steps which affect the result (zeroinstall's model classes use __slots__,
+# so we have to list them). The URL doesn't matter because we key on the archive's SHA-1 instead.
+_step_params = ['size', 'extract', 'dest', 'type', 'start_offset', 'executable', 'source', 'path']
+
+class IncomingMethod(object):
+	"""A download method from an incoming feed, on its way through the checks.
+	Creating one only looks at the XML and the incoming directory listing; the more expensive
+	checks are separate methods, so that the cheap ones can be done for everything first."""
+
+	def __init__(self, incoming_dir, impl, method, required_digest):
+		self.impl = impl
+		self.recipe = _as_recipe(method)
+		self.required_digest = required_digest
+		self.external_steps = []
+		self.local_archives = []	# (step, basename, path in incoming_dir)
+		for step in self.recipe.steps:
+			if not hasattr(step, 'url'): continue
+			if '/' in step.url:
+				self.external_steps.append(step)		# Hosted externally
+			else:
+				self.local_archives.append((step, step.url, _find_incoming_archive(incoming_dir, step.url)))
+
+	def check_sizes_and_hashes(self, config):
+		"""Check each local archive has the size given in the XML and, if we already have an
+		archive with the same name, that it's identical."""
+		for step, archive, archive_path in self.local_archives:
+			actual_size = os.path.getsize(archive_path)
 			if step.size != actual_size:
 				raise SafeException("Archive '{archive}' has size '{actual}', but XML says size should be {expected}".format(
 					archive = archive,
 					actual = actual_size,
 					expected = step.size))
-			archives.append(stored_archive)
-
-		step.url = os.path.abspath(archive_path)			# (just used below to test it)
+			existing = config.archive_db.entries.get(archive, None)
+			if existing is not None:
+				_assert_identical_archives(archive, sha1 = get_sha1(archive_path, config), existing = existing)
+
+	def check_external_urls(self, config):
+		test_archive = getattr(config, 'check_external_archive', _default_archive_test)
+		for step in self.external_steps:
+			with stats.phase('incoming/url-checks'):
+				test_archive(step, step.url)
+
+	def get_digest_key(self, config):
+		"""A hash of the SHA-1 of each archive and the parameters of each step, for the DigestCache."""
+		local_paths = {id(step): archive_path for step, archive, archive_path in self.local_archives}
+		steps = []
+		for step in self.recipe.steps:
+			params = {name: getattr(step, name, None) for name in _step_params}
+			if id(step) in local_paths:
+				params['sha1'] = get_sha1(local_paths[id(step)], config)
+			steps.append([type(step).__name__, params])
+		return hashlib.sha256(json.dumps(steps, sort_keys = True).encode('utf-8')).hexdigest()
+
+	def is_verified(self, config):
+		"""Whether the DigestCache says we've already checked that these archives give the required digest."""
+		digest_cache = getattr(config, 'digest_cache', None)
+		if digest_cache is None or self.external_steps:
+			return False
+		return digest_cache.is_verified(self.get_digest_key(config), self.required_digest)
+
+	def check_digest(self, config):
+		"""Check the archives unpack to give the required digest (not done if some are hosted externally)."""
+		if self.external_steps:
+			return
+		digest_cache = getattr(config, 'digest_cache', None)
+		if digest_cache is not None:
+			digest_key = self.get_digest_key(config)	# (before we change the URLs)
+		for step, archive, archive_path in self.local_archives:
+			step.url = os.path.abspath(archive_path)
+		_check_digest(config, self.impl, self.recipe, self.required_digest)
+		if digest_cache is not None:
+			digest_cache.add(digest_key, self.required_digest)
+
+	def store(self, config):
+		"""Copy the archives which aren't in the repository yet to LOCAL_ARCHIVES_BACKUP_DIR.
+		Returns the new Archives, ready for upload_archives."""
+		archives = []
+		for step, archive, archive_path in self.local_archives:
+			if archive in config.archive_db.entries:
+				continue
+			archive_rel_url = paths.get_archive_rel_url(config, archive, self.impl)
 
-	if not has_external_archives and getattr(config, 'CHECK_DIGESTS', True) and os.name != 'nt':
-		# Check archives unpack to give the correct digests
-		impl.feed.local_path = "/is-local-hack.xml"
+			backup_dir = config.LOCAL_ARCHIVES_BACKUP_DIR	# note: may be relative; that's OK
+			backup_target_dir = join(backup_dir, dirname(archive_rel_url))
+			paths.ensure_dir(backup_target_dir)
+			copy_path = join(backup_dir, archive_rel_url)
+			with stats.phase('incoming/copies'):
+				sha1 = link_or_copy(config, archive_path, copy_path)
+
+			archives.append(Archive(abspath(copy_path), archive_rel_url, step.size, archive_path, sha1))
+		return archives
+
+def check_incoming_archives(config, incoming_dir, feed):
+	"""The cheap checks on an incoming feed's archives, which don't copy, unpack or download anything:
+	first that every implementation has a usable digest and its archives are in incoming_dir, then their
+	sizes and (for archives we already have) their SHA-1s. Returns an IncomingMethod for each download method."""
+	methods = []
+	with stats.rejections('metadata'):
+		for impl in list(feed.implementations.values()):
+			required_digest = pick_digest(impl)
+			for method in impl.download_sources:
+				methods.append(IncomingMethod(incoming_dir, impl, method, required_digest))
+	with stats.rejections('sizes and hashes'):
+		for method in methods:
+			method.check_sizes_and_hashes(config)
+	return methods
+
+_digest_work = None		# (config, [IncomingMethod]), set in the parent before forking digest workers
+
+def _init_digest_worker(config):
+	"""Apply the DIGEST_SCRATCH_DIR and DIGEST_MEMORY_LIMIT settings to this (worker) process."""
+	scratch_dir = getattr(config, 'DIGEST_SCRATCH_DIR', None)
+	if scratch_dir:
+		scratch_dir = abspath(scratch_dir)
+		os.makedirs(scratch_dir, exist_ok = True)	# (the other workers may be creating it too)
+		os.environ['TMPDIR'] = scratch_dir
+		tempfile.tempdir = scratch_dir
+	memory_limit = getattr(config, 'DIGEST_MEMORY_LIMIT', None)
+	if memory_limit:
+		import resource
+		resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def _check_digest_in_worker(i):
+	config, methods = _digest_work
+	try:
+		methods[i].check_digest(config)
+	except Exception as ex:
 		try:
-			blocker = config.zconfig.fetcher.cook(required_digest, method,
-						config.zconfig.stores, impl_hint = impl, dry_run = True, may_use_mirror = False)
-			tasks.wait_for_blocker(blocker)
-		finally:
-			impl.feed.local_path = None
-
+			pickle.dumps(ex)
+		except Exception:
+			ex = SafeException(str(ex))
+		return ex		# (re-raised in the parent)
+	return None
+
+def _check_digests(config, methods):
+	"""Check the digests of 'methods', using up to DIGEST_JOBS worker processes.
+	If any fail, the error for the first failing method is raised, as if they were checked in order."""
+	if not _should_check_digests(config):
+		return
+	global _digest_work
+	import multiprocessing
+	methods = [method for method in methods if not method.external_steps]
+	verified = [method for method in methods if method.is_verified(config)]
+	if verified:
+		stats.count('digest checks reused', len(verified))
+		methods = [method for method in methods if method not in verified]
+	jobs = min(getattr(config, 'DIGEST_JOBS', min(4, os.cpu_count() or 1)), len(methods))
+	limited = getattr(config, 'DIGEST_SCRATCH_DIR', None) or getattr(config, 'DIGEST_MEMORY_LIMIT', None)
+	with stats.rejections('digests'):
+		if multiprocessing.current_process().daemon:
+			# We're already a worker (validating incoming feeds in parallel), and can't start our own
+			_init_digest_worker(config)
+		elif jobs > 1 or (limited and methods):
+			_digest_work = (config, methods)
+			try:
+				with stats.phase('incoming/digests'):
+					with multiprocessing.get_context('fork').Pool(jobs, _init_digest_worker, (config,)) as pool:
+						for error in pool.imap(_check_digest_in_worker, range(len(methods))):
+							if error is not None:
+								raise error
+			finally:
+				_digest_work = None
+			return
+		for method in methods:
+			method.check_digest(config)
+
+def _process_methods(config, methods, check_digests):
+	"""The expensive steps, once check_incoming_archives has passed: check any external URLs and
+	the digests, and only then copy the new archives. Returns the new Archives."""
+	with stats.rejections('url-checks'):
+		for method in methods:
+			method.check_external_urls(config)
+	if check_digests:
+		_check_digests(config, methods)
+	archives = []
+	for method in methods:
+		archives += method.store(config)
 	return archives
 
+def process_method(config, incoming_dir, impl, method, required_digest, check_digests = True):
+	with stats.rejections('metadata'):
+		method = IncomingMethod(incoming_dir, impl, method, required_digest)
+	with stats.rejections('sizes and hashes'):
+		method.check_sizes_and_hashes(config)
+	return _process_methods(config, [method], check_digests)
+
+def check_incoming_digests(config, incoming_dir, feed):
+	"""Do the checks in check_incoming_archives, then check that the archives unpack to give the
+	digests given in feed, without copying or uploading anything (so this can be done in parallel for
+	several incoming feeds). process_archives can then be told not to check the digests again."""
+	_check_digests(config, check_incoming_archives(config, incoming_dir, feed))
+
 StoredArchive = collections.namedtuple('StoredArchive', ['url', 'sha1'])
 
 class ArchiveDB:
@@ -170,29 +656,30 @@ def pick_digest(impl):
 
 # Copy to archives directory and upload
 def upload_archives(config, archives):
-	config.upload_archives(archives)
+	with stats.phase('upload-archives'):
+		config.upload_archives(archives)
 	
 	test_archive = getattr(config, 'check_uploaded_archive', _default_archive_test)
 
-	for archive in archives:
-		url = config.ARCHIVES_BASE_URL + archive.rel_url
-		test_archive(archive, url)
+	with stats.phase('upload-archives/url-checks'):
+		for archive in archives:
+			url = config.ARCHIVES_BASE_URL + archive.rel_url
+			test_archive(archive, url)
 
 	for archive in archives:
-		sha1 = get_sha1(archive.source_path)
+		sha1 = archive.sha1 or get_sha1(archive.source_path, config)
 		config.archive_db.add(archive.basename, config.ARCHIVES_BASE_URL + archive.rel_url, sha1)
 
-def process_archives(config, incoming_dir, feed):
-	"""feed is the parsed XML being processed. Any archives are in 'incoming_dir'."""
+def process_archives(config, incoming_dir, feed, check_digests = True):
+	"""feed is the parsed XML being processed. Any archives are in 'incoming_dir'.
+	If check_digests is False, the archives' digests must already have been checked."""
 
 	# Pick a digest to check (maybe we should check all of them?)
 	# Find required archives and check they're in 'incoming'
-	archives = []
-	for impl in list(feed.implementations.values()):
-		required_digest = pick_digest(impl)
-		for method in impl.download_sources:
-			archives += process_method(config, incoming_dir, impl, method, required_digest)
+	methods = check_incoming_archives(config, incoming_dir, feed)
+	archives = _process_methods(config, methods, check_digests)
 
-	upload_archives(config, archives)
+	with stats.rejections('upload'):
+		upload_archives(config, archives)
 
 	return archives
@@ -6,25 +6,31 @@
 import os, subprocess, sys
 from os.path import join, dirname, relpath, basename, abspath
 from xml.dom import minidom, Node
-import base64
+import base64, hashlib
+from io import BytesIO, StringIO, TextIOWrapper
 from collections import namedtuple
 
 from zeroinstall.injector.namespaces import XMLNS_IFACE
 from zeroinstall.support import xmltools
 from zeroinstall import SafeException, support
 
-from repo import paths
+from repo import paths, stats, compress, cache
 
-PublicFeed = namedtuple("PublicFeed", ["source_path", "public_rel_path", "doc", "changed"])
+# summary is the feed's catalog.FeedSummary, if it was generated without keeping its DOM (doc is None)
+PublicFeed = namedtuple("PublicFeed", ["source_path", "public_rel_path", "doc", "changed", "summary"])
 
 feed_header = """<?xml version="1.0" ?>
 <?xml-stylesheet type='text/xsl' href='%s/feed.xsl'?>
 """
 
-def sign_xml(config, source_xml):
-	if not config.GPG_SIGNING_KEY:
-		return source_xml
+def add_signature(source_xml, signature):
+	encoded = base64.encodebytes(signature)
+	sig = b"<!-- Base64 Signature\n" + encoded + b"\n-->\n"
+	return source_xml + sig
 
+def detach_sign(config, source_xml):
+	"""Get a detached (binary) GPG signature for source_xml."""
+	stats.count('gpg processes')
 	child = subprocess.Popen(['gpg', '--detach-sign', '--default-key', config.GPG_SIGNING_KEY, '--use-agent', '--output', '-', '-'],
 			stdin = subprocess.PIPE,
 			stdout = subprocess.PIPE,
@@ -35,10 +41,7 @@ def sign_xml(config, source_xml):
 		raise SafeException("Error signing feed: %s" % stderr)
 	if stderr:
 		print(stderr.decode().strip(), file=sys.stderr)
-
-	encoded = base64.encodebytes(stdout)
-	sig = b"<!-- Base64 Signature\n" + encoded + b"\n-->\n"
-	return source_xml + sig
+	return stdout
 
 def import_missing_archive(config, impl, archive):
 	from io import BytesIO
@@ -57,7 +60,13 @@ def import_missing_archive(config, impl, archive):
 		os.unlink(x.incoming_path)
 	return config.archive_db.lookup(archive)
 
-def expand_impl_relative_urls(config, parent, impl):
+def missing_archive_error(config, archive):
+	return SafeException("Missing entry for {basename} in {db}; can't build feeds."
+			     "Place missing archives in 'incoming' and try again.".format(
+		basename = archive,
+		db = config.archive_db.path))
+
+def expand_impl_relative_urls(config, parent, impl, resolved = None):
 	for elem in parent.childNodes:
 		if elem.nodeType != Node.ELEMENT_NODE: continue
 		if elem.namespaceURI != XMLNS_IFACE: continue
@@ -67,28 +76,31 @@ def expand_impl_relative_urls(config, parent, impl):
 			assert archive
 			if '/' not in archive:
 				x = config.archive_db.lookup(archive)
+				if not x and _is_worker:
+					raise DeferToParent()		# (the parent may have added it since we forked)
 				if not x and os.path.exists(os.path.join('incoming', archive)):
 					x = import_missing_archive(config, impl, archive)
 				if not x:
-					raise SafeException("Missing entry for {basename} in {db}; can't build feeds."
-							    "Place missing archives in 'incoming' and try again.".format(
-						basename = archive,
-						db = config.archive_db.path))
+					raise missing_archive_error(config, archive)
 				elem.setAttribute('href', x.url)
+				if resolved is not None:
+					resolved[archive] = x.url
 		elif elem.localName == 'recipe':
-			expand_impl_relative_urls(config, elem, impl = impl)
+			expand_impl_relative_urls(config, elem, impl = impl, resolved = resolved)
 
-def expand_relative_urls(config, parent):
+def expand_relative_urls(config, parent, resolved = None):
+	"""Make relative archive URLs absolute.
+	If 'resolved' is given, each archive basename is recorded there with the URL used."""
 	for elem in parent.childNodes:
 		if elem.nodeType != Node.ELEMENT_NODE: continue
 		if elem.namespaceURI != XMLNS_IFACE: continue
 
 		if elem.localName == 'group':
-			expand_relative_urls(config, elem)
+			expand_relative_urls(config, elem, resolved)
 		elif elem.localName == 'implementation':
-			expand_impl_relative_urls(config, elem, impl = elem)
+			expand_impl_relative_urls(config, elem, impl = elem, resolved = resolved)
 
-def generate_public_xml(config, source_xml_path):
+def generate_public_xml(config, source_xml_path, resolved = None):
 	"""Load source_xml_path and expand any relative URLs."""
 	try:
 		with open(source_xml_path, 'rb') as stream:
@@ -98,7 +110,14 @@ def generate_public_xml(config, source_xml_path):
 		raise
 
 	root = doc.documentElement
-	declared_iface = root.getAttribute('uri')
+	check_declared_uri(config, source_xml_path, root.getAttribute('uri'))
+
+	expand_relative_urls(config, root, resolved)
+
+	return doc
+
+def check_declared_uri(config, source_xml_path, declared_iface):
+	"""Check that the feed at source_xml_path has the right 'uri' attribute for its location."""
 	if not declared_iface:
 		raise SafeException("Feed '{path}' missing 'uri' attribute on root".format(path = source_xml_path))
 
@@ -116,9 +135,287 @@ def generate_public_xml(config, source_xml_path):
 			uri = declared_iface,
 			expected_path = expected_path))
 
-	expand_relative_urls(config, root)
-
-	return doc
+class NeedsDOM(Exception):
+	"""The streaming transformer can't handle this feed; use generate_public_xml instead."""
+
+# How much of each element _StreamingExpander copies to its summary output
+_ROOT = 'root'		# The element and its children (the other children of <group> and <implementation> elements in full)
+_SKELETON = 'skeleton'	# The element and any <group>, <implementation>, <name> or <replaced-by> children
+_FULL = 'full'		# Everything
+_BARE = 'bare'		# Just the element name and its text (for <name> and <replaced-by> elements elsewhere)
+
+class _StreamingExpander:
+	"""Expat handlers which write out the root element of a feed with relative archive URLs expanded,
+	exactly as doc.documentElement.toxml() would after generate_public_xml.
+	A cut-down copy is also written to 'summary_out', with just the parts catalog.summarise_feed needs
+	(without the contents of the implementations, which is most of a large feed)."""
+	def __init__(self, config, source_xml_path, resolved, out, summary_out):
+		self.config = config
+		self.source_xml_path = source_xml_path
+		self.resolved = resolved
+		self.out = out
+		self.summary_out = summary_out
+		self.stack = []			# (namespaces, namespace URI, local name, summary mode) for each open element
+		self.pending = None		# A start tag we haven't closed yet, since we don't know if it's empty
+		self.summary_pending = None	# The same, for summary_out
+		self.cdata = None		# Text of the CDATA section being read, if any
+		self.doc = minidom.Document()	# (we use minidom to escape things, so the output is identical)
+
+	def flush(self):
+		if self.pending is not None:
+			self.out.write(self.pending + '>')
+			self.pending = None
+		if self.summary_pending is not None:
+			self.summary_out.write(self.summary_pending + '>')
+			self.summary_pending = None
+
+	def write(self, data):
+		self.out.write(data)
+		if self.stack and self.stack[-1][3] in (_FULL, _BARE, _ROOT):
+			self.summary_out.write(data)
+
+	def summary_mode(self, name, uri, local_name):
+		"""How much of this element (a child of the top of the stack) to copy to summary_out."""
+		if not self.stack:
+			return _ROOT
+		parent_mode = self.stack[-1][3]
+		if parent_mode == _FULL:
+			return _FULL
+		if parent_mode in (_ROOT, _SKELETON) and uri == XMLNS_IFACE and local_name in ('group', 'implementation'):
+			return _SKELETON
+		if parent_mode == _ROOT:
+			return _FULL
+		if name in ('name', 'replaced-by'):
+			return _BARE
+		return None
+
+	def start_element(self, name, attrs):
+		self.flush()
+
+		namespaces = dict(self.stack[-1][0]) if self.stack else {}
+		decls = []
+		others = []
+		for i in range(0, len(attrs), 2):
+			attr_name, value = attrs[i:i + 2]
+			if attr_name == 'xmlns' or attr_name.startswith('xmlns:'):
+				namespaces[attr_name[6:]] = value
+				decls.append((attr_name, value))
+			else:
+				others.append([attr_name, value])
+
+		prefix, unused, local_name = name.rpartition(':')
+		uri = namespaces.get(prefix, None)
+
+		if not self.stack:
+			check_declared_uri(self.config, self.source_xml_path, dict(others).get('uri', None))
+		elif uri == XMLNS_IFACE and local_name in ('archive', 'file') and self.in_impl():
+			for attr in others:
+				if attr[0] == 'href':
+					attr[1] = self.expand(attr[1])
+					break
+			else:
+				raise AssertionError("Missing href")
+
+		# (minidom puts namespace declarations first)
+		elem = self.doc.createElement(name)
+		for attr_name, value in decls + others:
+			elem.setAttribute(attr_name, value)
+		start_tag = StringIO()
+		elem.writexml(start_tag)
+		self.pending = start_tag.getvalue()[:-2]
+
+		mode = self.summary_mode(name, uri, local_name)
+		if mode == _BARE:
+			self.summary_pending = '<' + name
+		elif mode is not None:
+			self.summary_pending = self.pending
+
+		self.stack.append((namespaces, uri, local_name, mode))
+
+	def in_impl(self):
+		"""Are we directly inside an <implementation> (or a <recipe> in one), as expand_relative_urls requires?"""
+		names = [local_name for namespaces, uri, local_name, mode in self.stack[1:] if uri == XMLNS_IFACE]
+		if len(names) != len(self.stack) - 1:
+			return False
+		while names and names[-1] == 'recipe':
+			names.pop()
+		return bool(names) and names[-1] == 'implementation' and all(x == 'group' for x in names[:-1])
+
+	def expand(self, archive):
+		assert archive
+		if '/' in archive:
+			return archive
+		x = self.config.archive_db.lookup(archive)
+		if not x:
+			if _is_worker:
+				raise DeferToParent()
+			if os.path.exists(os.path.join('incoming', archive)):
+				raise NeedsDOM()
+			raise missing_archive_error(self.config, archive)
+		self.resolved[archive] = x.url
+		return x.url
+
+	def end_element(self, name):
+		if self.pending is not None:
+			self.out.write(self.pending + '/>')
+			self.pending = None
+		else:
+			self.out.write('</%s>' % name)
+		if self.stack[-1][3] is not None:
+			if self.summary_pending is not None:
+				self.summary_out.write(self.summary_pending + '/>')
+				self.summary_pending = None
+			else:
+				self.summary_out.write('</%s>' % name)
+		self.stack.pop()
+
+	def character_data(self, data):
+		if not self.stack: return
+		if self.cdata is not None:
+			self.cdata.append(data)
+		elif data:
+			self.flush()
+			text = StringIO()
+			self.doc.createTextNode(data).writexml(text)
+			self.write(text.getvalue())
+
+	def start_cdata(self):
+		self.cdata = []
+
+	def end_cdata(self):
+		data = ''.join(self.cdata)
+		self.cdata = None
+		if data:
+			self.flush()
+			text = StringIO()
+			self.doc.createCDATASection(data).writexml(text)
+			self.write(text.getvalue())
+
+	def comment(self, data):
+		if not self.stack: return
+		self.flush()
+		self.write('<!--%s-->' % data)
+
+	def processing_instruction(self, target, data):
+		if not self.stack: return
+		self.flush()
+		self.write('<?%s %s?>' % (target, data))
+
+def stream_public_xml(config, source_xml_path, resolved):
+	"""Like generate_public_xml, but streams the source feed through expat rather than building a DOM.
+	Returns the root element serialised as doc.documentElement.toxml('utf-8') would, and the feed's
+	catalog.FeedSummary (generated from a cut-down DOM with just the parts the catalogs need).
+	@raise NeedsDOM: if the feed refers to archives which must be imported first."""
+	from xml.parsers import expat
+	from repo import catalog
+	output = BytesIO()
+	out = TextIOWrapper(output, encoding = 'utf-8', errors = 'xmlcharrefreplace', newline = '\n')
+	summary_out = StringIO()
+
+	expander = _StreamingExpander(config, source_xml_path, resolved, out, summary_out)
+	parser = expat.ParserCreate()
+	parser.ordered_attributes = True
+	parser.buffer_text = True
+	parser.StartElementHandler = expander.start_element
+	parser.EndElementHandler = expander.end_element
+	parser.CharacterDataHandler = expander.character_data
+	parser.StartCdataSectionHandler = expander.start_cdata
+	parser.EndCdataSectionHandler = expander.end_cdata
+	parser.CommentHandler = expander.comment
+	parser.ProcessingInstructionHandler = expander.processing_instruction
+	try:
+		with open(source_xml_path, 'rb') as stream:
+			parser.ParseFile(stream)
+	except expat.ExpatError:
+		print("Failed to process %s" % (source_xml_path))
+		raise
+	out.flush()
+	out.detach()
+	summary_doc = minidom.parseString(summary_out.getvalue())
+	return output.getvalue(), catalog.summarise_feed(config, summary_doc.documentElement)
+
+def load_public_doc(public_feed):
+	"""Get the DOM of a feed which build_public_feeds skipped without parsing (doc is None)."""
+	if public_feed.doc is not None:
+		return public_feed.doc
+	stats.count('public feeds parsed')
+	with open(join('public', public_feed.public_rel_path), 'rb') as stream:
+		return minidom.parse(stream)
+
+def get_sha256(path):
+	sha256 = hashlib.sha256()
+	with open(path, 'rb') as stream:
+		while True:
+			got = stream.read(65536)
+			if not got: break
+			sha256.update(got)
+			stats.count('bytes hashed', len(got))
+	return sha256.hexdigest()
+
+class BuildManifest:
+	"""Records what each public feed was generated from, so that feeds whose inputs haven't changed
+	can be skipped without being parsed at all."""
+	format_version = 1
+
+	def __init__(self, path, settings, full = False):
+		self.path = path
+		self.settings = settings
+		self.entries = {}		# Feeds rel path -> entry from the previous run
+		self.new_entries = {}		# Feeds rel path -> entry for this run
+		data = None if full else cache.load_json(path, self.format_version, settings)
+		if data is not None:
+			self.entries = data['feeds']
+
+	def is_up_to_date(self, config, feeds_rel_path, public_rel_path):
+		entry = self.entries.get(feeds_rel_path, None)
+		if entry is None or entry['public'] != public_rel_path:
+			return False
+
+		source_path = join('feeds', feeds_rel_path)
+		info = os.stat(source_path)
+		if [info.st_size, info.st_mtime_ns] != entry['source']:
+			# (e.g. touched by a Git checkout, but with the same contents)
+			if info.st_size != entry['source'][0] or get_sha256(source_path) != entry['sha256']:
+				return False
+			entry['source'] = [info.st_size, info.st_mtime_ns]
+
+		try:
+			info = os.stat(join('public', public_rel_path))
+		except OSError:
+			return False
+		if [info.st_size, info.st_mtime_ns] != entry['target']:
+			return False
+
+		for archive, url in entry['archives'].items():
+			x = config.archive_db.lookup(archive)
+			if x is None or x.url != url:
+				return False
+
+		self.new_entries[feeds_rel_path] = entry
+		return True
+
+	def record(self, feeds_rel_path, public_rel_path, resolved):
+		source_path = join('feeds', feeds_rel_path)
+		source_info = os.stat(source_path)
+		target_info = os.stat(join('public', public_rel_path))
+		self.new_entries[feeds_rel_path] = {
+			'public': public_rel_path,
+			'source': [source_info.st_size, source_info.st_mtime_ns],
+			'sha256': get_sha256(source_path),
+			'target': [target_info.st_size, target_info.st_mtime_ns],
+			'archives': resolved,
+		}
+
+	def save(self):
+		cache.save_json(self.path, self.format_version, {'settings': self.settings, 'feeds': self.new_entries})
+
+def get_build_settings(config):
+	"""The configuration settings which affect the contents of the public feeds."""
+	return {
+		'REPOSITORY_BASE_URL': config.REPOSITORY_BASE_URL,
+		'GPG_SIGNING_KEY': config.GPG_SIGNING_KEY,
+		'feed_header': feed_header,
+	}
 
 def export_key(dir, signing_key):
 	assert signing_key is not None
@@ -127,6 +424,7 @@ def export_key(dir, signing_key):
 
 	# Convert signing_key to key ID
 	keyID = None
+	stats.count('gpg processes')
 	keys_output = subprocess.check_output(['gpg', '--with-colons', '--list-keys', signing_key], encoding='utf-8')
 	for line in keys_output.split('\n'):
 		parts = line.split(':')
@@ -139,27 +437,178 @@ def export_key(dir, signing_key):
 	key_file = os.path.join(dir, keyID + '.gpg')
 	if not os.path.isfile(key_file):
 		with open(key_file, 'w') as key_stream:
+			stats.count('gpg processes')
 			subprocess.check_call(["gpg", "-a", "--export", signing_key], stdout = key_stream)
 		print("Exported public key as '%s'" % key_file)
 	return key_file
 
-def build_public_feeds(config):
-	feeds = []
+def get_public_xml(public_rel_path, root_xml):
+	"""Get the unsigned contents of a public feed, given its serialised root element."""
+	target_path = join('public', public_rel_path)
+	path_to_resources = relpath(join('public', 'resources'), dirname(target_path)).replace(os.sep, '/')
+	return (feed_header % path_to_resources).encode('utf-8') + root_xml + b'\n'
+
+def get_unsigned(signed_xml):
+	"""Remove the signature added by add_signature, if any."""
+	sig_index = signed_xml.rfind(b'<!-- Base64 Signature')
+	if sig_index == -1:
+		return signed_xml
+	return signed_xml[:sig_index]
+
+class PublicHashes:
+	"""An index of the SHA-256 of the unsigned contents of each file we generate in 'public', along with
+	the size and mtime of the signed file when we wrote it. This lets us tell whether a file needs
+	updating without parsing the old version."""
+	format_version = 1
+
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}		# Rel path in public -> [sha256, size, mtime_ns]
+		data = cache.load_json(path, self.format_version)
+		if data is not None:
+			self.entries = data['files']
+
+	def has_changed(self, rel_path, new_sha256):
+		"""Returns True or False, or None if we don't know (the file is not indexed, or was modified since)."""
+		entry = self.entries.get(rel_path, None)
+		if entry is None:
+			return None
+		try:
+			info = os.stat(join('public', rel_path))
+		except OSError:
+			return None
+		if [info.st_size, info.st_mtime_ns] != entry[1:]:
+			return None
+		return entry[0] != new_sha256
+
+	def record(self, rel_path, sha256):
+		info = os.stat(join('public', rel_path))
+		self.entries[rel_path] = [sha256, info.st_size, info.st_mtime_ns]
+
+	def save(self):
+		cache.save_json(self.path, self.format_version, {'files': self.entries})
+
+def load_public_hashes():
+	return PublicHashes(join('public', '.0repo-hashes.json'))
+
+def build_public_feed(config, source_path, public_rel_path, public_hashes):
+	"""Generate the public version of a feed and compare it with the existing one.
+	Feeds of at least config.STREAMING_FEED_SIZE bytes are converted without building a DOM.
+	Returns (doc, unsigned XML, SHA-256 of the XML, changed, resolved archives, summary).
+	If streamed, doc is None and summary is the feed's catalog.FeedSummary; otherwise summary is None."""
+	target_path = join("public", public_rel_path)
+	resolved = {}
+	new_doc = None
+	new_xml = None
+	summary = None
+	streaming_size = getattr(config, 'STREAMING_FEED_SIZE', 1024 * 1024)
+	if streaming_size is not None and os.path.getsize(source_path) >= streaming_size:
+		stats.count('feeds streamed')
+		try:
+			root_xml, summary = stream_public_xml(config, source_path, resolved)
+			new_xml = get_public_xml(public_rel_path, root_xml)
+		except NeedsDOM:
+			resolved = {}
+	if new_xml is None:
+		new_doc = generate_public_xml(config, source_path, resolved)
+		new_xml = get_public_xml(public_rel_path, new_doc.documentElement.toxml('utf-8'))
+	new_sha256 = hashlib.sha256(new_xml).hexdigest()
+	changed = True
+	if os.path.exists(target_path):
+		changed = public_hashes.has_changed(public_rel_path, new_sha256)
+		if changed is None:
+			if new_doc is None:
+				# (avoid parsing large feeds; at worst, we re-sign a feed unnecessarily)
+				with open(target_path, 'rb') as stream:
+					changed = get_unsigned(stream.read()) != new_xml
+			else:
+				with open(target_path, 'rb') as stream:
+					old_doc = minidom.parse(stream)
+				changed = not xmltools.nodes_equal(old_doc.documentElement, new_doc.documentElement)
+	return new_doc, new_xml, new_sha256, changed, resolved, summary
+
+class DeferToParent(Exception):
+	"""A build worker needs to do something which must happen in the main process."""
+
+_worker_args = None		# (config, public_hashes), set in the parent before forking build workers
+_is_worker = False
+
+def _init_worker():
+	global _is_worker
+	_is_worker = True
+
+def _build_public_feed_in_worker(args):
+	source_path, public_rel_path = args
+	config, public_hashes = _worker_args
+	try:
+		doc, new_xml, new_sha256, changed, resolved, summary = build_public_feed(config, source_path, public_rel_path, public_hashes)
+	except DeferToParent:
+		return None
+	# (the DOM is expensive to send back, so send the catalog summary instead)
+	if summary is None:
+		from repo import catalog
+		summary = catalog.summarise_feed(config, doc.documentElement)
+	return new_xml if changed else None, new_sha256, changed, resolved, summary
+
+def _build_in_parallel(config, to_build, public_hashes, jobs):
+	"""Run build_public_feed on each (source_path, public_rel_path) in a pool of 'jobs' processes.
+	Yields the results in order. doc is None if it was generated by a worker (summary is set instead),
+	and so is new_xml if it hasn't changed."""
+	global _worker_args
+	import multiprocessing
+	_worker_args = (config, public_hashes)
+	try:
+		with multiprocessing.get_context('fork').Pool(jobs, initializer = _init_worker) as pool:
+			results = pool.imap(_build_public_feed_in_worker, to_build, chunksize = 4)
+			for (source_path, public_rel_path), result in zip(to_build, results):
+				if result is None:
+					# e.g. needs to import a missing archive
+					yield build_public_feed(config, source_path, public_rel_path, public_hashes)
+				else:
+					yield (None,) + result
+	finally:
+		_worker_args = None
+
+def build_public_feeds(config, full = False, jobs = 1):
+	"""Generate the signed feeds in 'public'.
+	Feeds whose source, archive URLs and public file are unchanged since the last run are skipped
+	without being parsed (their PublicFeed has doc = None), unless 'full' is set.
+	If jobs > 1, feeds are generated in that many worker processes and only written by this one."""
+	manifest = BuildManifest(paths.get_cache_path('build-manifest.json'), get_build_settings(config), full = full)
+	public_hashes = load_public_hashes()
+	generated = {}		# source_path -> (feeds_rel_path, resolved archives, SHA-256 of unsigned XML)
+	new_xml_for = {}	# source_path -> unsigned XML, for changed feeds
+
+	to_build = []
 	for dirpath, dirnames, filenames in os.walk('feeds'):
 		for f in filenames:
 			if f.endswith('.xml') and not f.startswith('.'):
 				source_path = join(dirpath, f)
-				public_rel_path = paths.get_public_rel_path(config, relpath(source_path, 'feeds'))
-				target_path = join("public", public_rel_path)
-				new_doc = generate_public_xml(config, source_path)
-				changed = True
-				if os.path.exists(target_path):
-					with open(target_path, 'rb') as stream:
-						old_doc = minidom.parse(stream)
-					if xmltools.nodes_equal(old_doc.documentElement, new_doc.documentElement):
-						#print("%s unchanged" % source_path)
-						changed = False
-				feeds.append(PublicFeed(abspath(source_path), public_rel_path, new_doc, changed))
+				feeds_rel_path = relpath(source_path, 'feeds')
+				public_rel_path = paths.get_public_rel_path(config, feeds_rel_path)
+				if manifest.is_up_to_date(config, feeds_rel_path, public_rel_path):
+					to_build.append((source_path, public_rel_path, None))
+				else:
+					to_build.append((source_path, public_rel_path, feeds_rel_path))
+
+	needed = [(source_path, public_rel_path) for source_path, public_rel_path, feeds_rel_path in to_build if feeds_rel_path]
+	stats.count('feeds generated', len(needed))
+	stats.count('feeds skipped as unchanged', len(to_build) - len(needed))
+	if jobs > 1 and len(needed) > 1 and os.name != 'nt':
+		results = _build_in_parallel(config, needed, public_hashes, jobs)
+	else:
+		results = (build_public_feed(config, source_path, public_rel_path, public_hashes) for source_path, public_rel_path in needed)
+
+	feeds = []
+	for source_path, public_rel_path, feeds_rel_path in to_build:
+		if feeds_rel_path is None:
+			feeds.append(PublicFeed(abspath(source_path), public_rel_path, None, False, None))
+			continue
+		new_doc, new_xml, new_sha256, changed, resolved, summary = next(results)
+		generated[abspath(source_path)] = (feeds_rel_path, resolved, new_sha256)
+		if changed:
+			new_xml_for[abspath(source_path)] = new_xml
+		feeds.append(PublicFeed(abspath(source_path), public_rel_path, new_doc, changed, summary))
 
 	if config.GPG_SIGNING_KEY:
 		key_path = export_key(join('public', 'keys'), config.GPG_SIGNING_KEY)
@@ -167,6 +616,7 @@ def build_public_feeds(config):
 	else:
 		other_files = []
 
+	to_write = []
 	for public_feed in feeds:
 		target_path = join('public', public_feed.public_rel_path)
 
@@ -188,14 +638,24 @@ def build_public_feeds(config):
 
 		if not public_feed.changed: continue
 
-		path_to_resources = relpath(join('public', 'resources'), dirname(target_path)).replace(os.sep, '/')
-		new_xml = (feed_header % path_to_resources).encode('utf-8') + public_feed.doc.documentElement.toxml('utf-8') + b'\n'
-
-		signed_xml = sign_xml(config, new_xml)
+		to_write.append((target_path, new_xml_for[public_feed.source_path]))
 
+	from repo import signing
+	for (target_path, new_xml), signed_xml in zip(to_write, signing.sign_all(config, to_write)):
 		with open(target_path + '.new', 'wb') as stream:
 			stream.write(signed_xml)
 		support.portable_rename(target_path + '.new', target_path)
 		print("Updated", target_path)
 
+	for public_feed in feeds:
+		other_files += compress.update_compressed(config, public_feed.public_rel_path)
+
+	for public_feed in feeds:
+		if public_feed.source_path in generated:
+			feeds_rel_path, resolved, new_sha256 = generated[public_feed.source_path]
+			public_hashes.record(public_feed.public_rel_path, new_sha256)
+			manifest.record(feeds_rel_path, public_feed.public_rel_path, resolved)
+	public_hashes.save()
+	manifest.save()
+
 	return feeds, other_files
@@ -0,0 +1,61 @@
+# Copyright (C) 2013, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+"""Helpers for the files in which 0repo remembers things between runs (mostly in 'cache')."""
+
+import os, json
+
+from zeroinstall import support
+
+def load_json(path, format_version, settings = None):
+	"""Load a file written by save_json. Returns None if there isn't one, or it was written in a different
+	format, or (if 'settings' is given) with different settings."""
+	if not os.path.exists(path):
+		return None
+	with open(path, 'rt') as stream:
+		data = json.load(stream)
+	if data.get('version') != format_version:
+		return None
+	if settings is not None and data.get('settings') != settings:
+		return None
+	return data
+
+def save_json(path, format_version, data):
+	"""Replace the file at 'path' with 'data' (a dict) plus the format version, as JSON."""
+	data = dict(data, version = format_version)
+	with open(path + '.new', 'wt') as stream:
+		json.dump(data, stream, indent = 1, sort_keys = True)
+	support.portable_rename(path + '.new', path)
+
+class RecordFile(object):
+	"""A text file with one record per line, each with 'n_fields' fields separated by 'separator'
+	(the last field may contain the separator). New records are appended to the end."""
+	def __init__(self, path, n_fields, separator = ' '):
+		self.path = path
+		self.n_fields = n_fields
+		self.separator = separator
+
+	def read(self):
+		"""Yields the fields of each record, in order. Lines without the right number of fields are skipped."""
+		if not os.path.exists(self.path):
+			return
+		with open(self.path, 'rt', encoding = 'utf-8') as stream:
+			for line in stream:
+				fields = line.rstrip('\n').split(self.separator, self.n_fields - 1)
+				if len(fields) == self.n_fields:
+					yield fields
+
+	def append(self, fields):
+		with open(self.path, 'at', encoding = 'utf-8') as stream:
+			stream.write(self._format(fields))
+
+	def rewrite(self, records):
+		"""Replace the contents of the file with 'records'."""
+		with open(self.path + '.new', 'wt', encoding = 'utf-8') as stream:
+			for fields in records:
+				stream.write(self._format(fields))
+		support.portable_rename(self.path + '.new', self.path)
+
+	def _format(self, fields):
+		assert len(fields) == self.n_fields, fields
+		return self.separator.join(str(field) for field in fields) + '\n'
@@ -5,15 +5,16 @@
 
 import os
 from os.path import dirname, join, relpath
-import collections
+import collections, hashlib, json
 from xml.dom import minidom
-from xml.dom import XMLNS_NAMESPACE
+from xml.dom import XMLNS_NAMESPACE, XML_NAMESPACE, Node
 
 from zeroinstall.injector.namespaces import XMLNS_IFACE
-from zeroinstall import support
+from zeroinstall.injector import model
+from zeroinstall import SafeException, support
 from zeroinstall.support import xmltools
 
-from . import namespace, build
+from . import namespace, build, signing, stats, paths, compress, cache
 
 XMLNS_CATALOG = "http://0install.de/schema/injector/catalog"
 
@@ -23,21 +24,228 @@ catalog_header = b'''<?xml version="1.0" encoding="utf-8"?>
 
 catalog_names = frozenset(["name", "summary", "description", "homepage", "icon", "category", "needs-terminal", "entry-point"])
 
-def write_catalogs(config, feeds):
-	feeds_by_directory = collections.defaultdict(lambda: [])
+class CatalogState:
+	"""Records which version of each feed every catalog was generated from, so that we only need
+	to regenerate catalogs for directories (or shards) where a feed has been changed, added or removed."""
+	format_version = 3
+
+	def __init__(self, path, settings, full = False):
+		self.path = path
+		self.settings = settings
+		self.catalogs = {}		# Catalog rel path -> {'members': {public rel path: hash entry}, 'catalog': hash entry,
+					#		       'index': [rel path], 'count': entries}
+		self.new_catalogs = {}
+		self.shard_files = []		# Files we wrote in public/catalog-shards last time (kept even if the settings change)
+		data = cache.load_json(path, self.format_version)
+		if data is not None:
+			self.shard_files = data.get('shard_files', [])
+			if not full and data.get('settings') == settings:
+				self.catalogs = data['catalogs']
+
+	def is_up_to_date(self, catalog_rel_path, members, public_hashes):
+		old = self.catalogs.get(catalog_rel_path, None)
+		if old is None or old['members'] != members or None in members.values():
+			return False
+		if public_hashes.entries.get(catalog_rel_path, None) != old['catalog']:
+			return False
+		if public_hashes.has_changed(catalog_rel_path, old['catalog'][0]) is not False:
+			return False
+		if not all(os.path.exists(join('public', index_file)) for index_file in old['index']):
+			return False
+		self.new_catalogs[catalog_rel_path] = old
+		return True
+
+	def record(self, catalog_rel_path, members, public_hashes, index_files, count):
+		self.new_catalogs[catalog_rel_path] = {
+			'members': members,
+			'catalog': public_hashes.entries.get(catalog_rel_path, None),
+			'index': index_files,
+			'count': count,
+		}
+
+	def save(self, shard_files):
+		cache.save_json(self.path, self.format_version, {'settings': self.settings, 'catalogs': self.new_catalogs,
+								'shard_files': shard_files})
+
+def get_catalog_settings(config):
+	"""The configuration settings which affect the contents of the catalogs."""
+	return {
+		'ADDITIONAL_CATALOG_TAGS': repr(getattr(config, 'ADDITIONAL_CATALOG_TAGS', [])),
+		'CATALOG_SHARDS': getattr(config, 'CATALOG_SHARDS', None),
+		'catalog_header': catalog_header.decode('utf-8'),
+	}
+
+# Directory (in 'public') holding the shards of the root catalog, when CATALOG_SHARDS is set
+shards_dir = 'catalog-shards'
+
+def get_shard_key(config, public_rel_path, summary):
+	"""Which shard of the root catalog a feed belongs in: its top-level directory ('_' if none) if
+	config.CATALOG_SHARDS is 'directory', or the first letter or digit of its name ('_' for others) for 'name'."""
+	sharding = config.CATALOG_SHARDS
+	if sharding == 'directory':
+		parts = public_rel_path.replace(os.sep, '/').split('/')
+		return parts[0] if len(parts) > 1 else '_'
+	elif sharding == 'name':
+		first = summary.name[:1].lower()
+		return first if first.isascii() and first.isalnum() else '_'
+	else:
+		raise SafeException("Invalid CATALOG_SHARDS setting {value!r} (should be None, 'directory' or 'name')".format(value = sharding))
+
+class FeedSummaries:
+	"""The parts of each feed that go into the catalogs, cached (keyed on the SHA-256 of the public feed)
+	so that assembling a catalog doesn't require parsing its feeds."""
+	format_version = 2
+
+	def __init__(self, path, settings, full = False):
+		self.path = path
+		self.settings = settings
+		self.summaries = {}		# Public rel path -> [sha256, uri, name, excluded, xml, index]
+		data = None if full else cache.load_json(path, self.format_version, settings)
+		if data is not None:
+			self.summaries = data['summaries']
+
+	def get(self, config, public_rel_path, sha256, load_doc, new_summary = None):
+		"""Get the FeedSummary for a feed. If it's not cached, use new_summary (if the build already
+		generated one) or call load_doc() to get the feed's document."""
+		summary = self.summaries.get(public_rel_path, None)
+		if summary is None or sha256 is None or summary[0] != sha256:
+			stats.count('catalog summaries generated')
+			if new_summary is None:
+				new_summary = summarise_feed(config, load_doc().documentElement)
+			summary = [sha256] + list(new_summary)
+			self.summaries[public_rel_path] = summary
+		return FeedSummary(*summary[1:])
+
+	def save(self, public_rel_paths):
+		"""Save the summaries of the given feeds (dropping any others)."""
+		summaries = {rel_path: self.summaries[rel_path] for rel_path in public_rel_paths if rel_path in self.summaries}
+		cache.save_json(self.path, self.format_version, {'settings': self.settings, 'summaries': summaries})
+
+# xml is the feed's <interface> element for the catalog, or None if it needs extra namespace declarations on the catalog root.
+# index is the feed's entry in the catalog's JSON search index.
+FeedSummary = collections.namedtuple('FeedSummary', ['uri', 'name', 'excluded', 'xml', 'index'])
+
+def write_catalogs(config, feeds, full = False):
+	"""Write a catalog for each directory containing feeds, plus one for the whole repository.
+	If config.CATALOG_SHARDS is set, the whole-repository catalog is split into shards (see get_shard_key)
+	and the root catalog.xml just lists them.
+	Catalogs are only regenerated if one of their feeds has changed, been added or been removed
+	since the last run (or if 'full' is set)."""
+	public_hashes = build.load_public_hashes()
+	settings = get_catalog_settings(config)
+	state = CatalogState(paths.get_cache_path('catalogs.json'), settings, full = full)
+	summary_settings = dict(settings)
+	del summary_settings['CATALOG_SHARDS']		# Doesn't affect the summaries
+	summaries = FeedSummaries(paths.get_cache_path('catalog-summaries.json'), summary_settings, full = full)
+
+	docs = {}
+	def load_doc(feed):
+		# Feeds skipped by the build weren't parsed; load their public versions
+		if feed.doc is not None:
+			return feed.doc
+		if feed.public_rel_path not in docs:
+			docs[feed.public_rel_path] = build.load_public_doc(feed)
+		return docs[feed.public_rel_path]
+
+	def get_summary(feed):
+		entry = public_hashes.entries.get(feed.public_rel_path, None)
+		return summaries.get(config, feed.public_rel_path, entry and entry[0], lambda: load_doc(feed), feed.summary)
+
+	feeds_by_catalog = collections.OrderedDict()	# Catalog rel path -> (dir rel path, feeds)
 	for feed in feeds:
-		feeds_by_directory[dirname(feed.public_rel_path)].append(feed)
-	feeds_by_directory[''] = feeds
+		dir_rel_path = dirname(feed.public_rel_path)
+		feeds_by_catalog.setdefault(join(dir_rel_path, 'catalog.xml'), (dir_rel_path, []))[1].append(feed)
+	sharded = getattr(config, 'CATALOG_SHARDS', None) is not None
+	if sharded:
+		shards = collections.defaultdict(lambda: [])
+		for feed in feeds:
+			shards[get_shard_key(config, feed.public_rel_path, get_summary(feed))].append(feed)
+		for key in sorted(shards):
+			feeds_by_catalog[join(shards_dir, key + '.xml')] = ('', shards[key])
+		if not os.path.isdir(join('public', shards_dir)):
+			os.makedirs(join('public', shards_dir))
+		feeds_by_catalog.pop('catalog.xml', None)
+	else:
+		feeds_by_catalog['catalog.xml'] = ('', feeds)
 
 	catalog_files = []
-	for dir_rel_path, feeds in list(feeds_by_directory.items()):
-		catalog_files.append(write_catalog(config, feeds, dir_rel_path))
+	to_write = []
+	pending = []		# (catalog_rel_path, members, index files, count) for regenerated catalogs
+	index_files = []
+	counts = {}		# Catalog rel path -> number of feeds listed
+	for catalog_rel_path, (dir_rel_path, catalog_feeds) in feeds_by_catalog.items():
+		catalog_files.append(catalog_rel_path)
+
+		members = {feed.public_rel_path: public_hashes.entries.get(feed.public_rel_path, None) for feed in catalog_feeds}
+		if state.is_up_to_date(catalog_rel_path, members, public_hashes):
+			stats.count('catalogs skipped as unchanged')
+			index_files += state.new_catalogs[catalog_rel_path]['index']
+			counts[catalog_rel_path] = state.new_catalogs[catalog_rel_path]['count']
+			continue
+
+		catalog_file, new_xml, entries = generate_catalog(config, catalog_feeds, dir_rel_path, public_hashes, get_summary, load_doc,
+								   catalog_rel_path = catalog_rel_path)
+		if new_xml is not None:
+			to_write.append((catalog_file, new_xml))
+		old_index_files = state.catalogs.get(catalog_rel_path, {}).get('index', [])
+		new_index_files = write_index(config, catalog_rel_path, [summary.index for summary in entries], old_index_files)
+		index_files += new_index_files
+		counts[catalog_rel_path] = len(entries)
+		pending.append((catalog_rel_path, members, new_index_files, len(entries)))
+
+	if sharded:
+		shard_paths = [catalog_rel_path for catalog_rel_path in feeds_by_catalog if dirname(catalog_rel_path) == shards_dir]
+		catalog_files.append('catalog.xml')
+		catalog_file, new_xml = generate_shard_index(config, shard_paths, public_hashes)
+		if new_xml is not None:
+			to_write.append((catalog_file, new_xml))
+		index_files.append('catalog.json')
+		_write_json('catalog.json', {
+			'count': sum(counts[shard_path] for shard_path in shard_paths),
+			'items': [],
+			'chunks': [shard_path[:-len('.xml')] + '.json' for shard_path in shard_paths],
+		})
+
+	for (catalog_file, new_xml), new_data in zip(to_write, signing.sign_all(config, to_write)):
+		write_signed(catalog_file, new_data)
+		public_hashes.record(relpath(catalog_file, 'public'), hashlib.sha256(new_xml).hexdigest())
+	public_hashes.save()
+
+	compressed_files = []
+	for rel_path in catalog_files + index_files:
+		compressed_files += compress.update_compressed(config, rel_path)
+	catalog_files += index_files + compressed_files
+	shard_files = [rel_path for rel_path in catalog_files if dirname(rel_path) == shards_dir]
+	_remove_old_shards(state.shard_files, shard_files)
+
+	for catalog_rel_path, members, new_index_files, count in pending:
+		state.record(catalog_rel_path, members, public_hashes, new_index_files, count)
+	state.save(shard_files)
+	summaries.save(feed.public_rel_path for feed in feeds)
+
 	return catalog_files
 
+def _remove_old_shards(old_files, current_files):
+	"""Delete the shard files we generated last time (old_files) but not this time.
+	Other files in the shards directory are left alone."""
+	current = set(current_files)
+	for rel_path in old_files:
+		path = join('public', rel_path)
+		if rel_path not in current and os.path.exists(path):
+			os.unlink(path)
+			print("Removed old catalog shard " + path)
+
 def _default_is_excluded_from_catalog(feed_root, dir_rel_path):
 	return feed_root.getElementsByTagName('replaced-by').length > 0
 
-def write_catalog(config, feeds, dir_rel_path):
+def write_signed(catalog_file, new_data):
+	with open(catalog_file + '.new', 'wb') as stream:
+		stream.write(new_data)
+	support.portable_rename(catalog_file + '.new', catalog_file)
+	print("Updated " + catalog_file)
+
+def _new_catalog_doc(config):
+	"""Create an empty catalog document. Returns (document, namespace, custom tags)."""
 	cat_ns = namespace.Namespace()
 	cat_ns.register_namespace(XMLNS_CATALOG, "c")
 
@@ -53,38 +261,178 @@ def write_catalog(config, feeds, dir_rel_path):
 		cat_root.setAttributeNS(XMLNS_NAMESPACE, 'xmlns:' + name, ns)
 		custom_tags[ns] = tags
 
-	feed_roots = [feed.doc.documentElement for feed in feeds]
+	return cat_doc, cat_ns, custom_tags
 
-	def get_name(feed_root):
-		return feed_root.getElementsByTagName('name')[0].firstChild.wholeText
+def _make_catalog_entry(cat_doc, cat_ns, custom_tags, feed_root):
+	elem = cat_doc.createElementNS(XMLNS_IFACE, "interface")
+	elem.setAttribute('uri', feed_root.getAttribute("uri"))
+	for feed_elem in feed_root.childNodes:
+		ns = feed_elem.namespaceURI
+		if ((ns == XMLNS_IFACE and feed_elem.localName in catalog_names) or
+			(ns in custom_tags and feed_elem.localName in custom_tags[ns])):
+			elem.appendChild(cat_ns.import_node(cat_doc, feed_elem))
+	return elem
 
-	is_excluded_from_catalog = getattr(config, 'is_excluded_from_catalog', _default_is_excluded_from_catalog)
+def _get_name(feed_root):
+	return feed_root.getElementsByTagName('name')[0].firstChild.wholeText
 
-	for feed_root in sorted(feed_roots, key=get_name):
-		if is_excluded_from_catalog(feed_root, dir_rel_path): continue
-		elem = cat_doc.createElementNS(XMLNS_IFACE, "interface")
-		elem.setAttribute('uri', feed_root.getAttribute("uri"))
-		for feed_elem in feed_root.childNodes:
-			ns = feed_elem.namespaceURI
-			if ((ns == XMLNS_IFACE and feed_elem.localName in catalog_names) or
-				(ns in custom_tags and feed_elem.localName in custom_tags[ns])):
-				elem.appendChild(cat_ns.import_node(cat_doc, feed_elem))
-		cat_root.appendChild(elem)
+def summarise_feed(config, feed_root):
+	"""Extract the parts of a feed needed for the catalogs, as a FeedSummary."""
+	cat_doc, cat_ns, custom_tags = _new_catalog_doc(config)
+	cat_root = cat_doc.documentElement
+	root_decls = list(cat_root.attributes.items())
+	elem = _make_catalog_entry(cat_doc, cat_ns, custom_tags, feed_root)
+	if list(cat_root.attributes.items()) == root_decls:
+		xml = elem.toxml()
+	else:
+		# The prefixes used would depend on the other feeds in the catalog
+		xml = None
+	return FeedSummary(feed_root.getAttribute("uri"), _get_name(feed_root),
+			   _default_is_excluded_from_catalog(feed_root, None), xml, _make_index_entry(feed_root))
 
-	catalog_file = join('public', dir_rel_path, 'catalog.xml')
+def _get_text(elem):
+	return ''.join(node.data for node in elem.childNodes if node.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE)).strip()
 
-	need_update = True
-	if os.path.exists(catalog_file):
-		with open(catalog_file, 'rb') as stream:
-			old_catalog = minidom.parse(stream)
-		need_update = not xmltools.nodes_equal(old_catalog.documentElement, cat_doc.documentElement)
+def _get_inherited(elem, name):
+	while elem.nodeType == Node.ELEMENT_NODE:
+		if elem.hasAttribute(name):
+			return elem.getAttribute(name)
+		elem = elem.parentNode
+	return None
+
+def _make_index_entry(feed_root):
+	"""The feed's entry in the JSON search index (uri, name, summary, categories, latest version and icon)."""
+	entry = {'uri': feed_root.getAttribute("uri"), 'name': _get_name(feed_root)}
+	summaries = []
+	categories = []
+	for elem in feed_root.childNodes:
+		if elem.namespaceURI != XMLNS_IFACE:
+			continue
+		if elem.localName == 'summary':
+			summaries.append(elem)
+		elif elem.localName == 'category':
+			categories.append(_get_text(elem))
+		elif elem.localName == 'icon' and elem.getAttribute('type') == 'image/png' and 'icon' not in entry:
+			entry['icon'] = elem.getAttribute('href')
+	if summaries:
+		english = [elem for elem in summaries if elem.getAttributeNS(XML_NAMESPACE, 'lang') in ('', 'en')]
+		entry['summary'] = _get_text((english or summaries)[0])
+	if categories:
+		entry['categories'] = categories
+	versions = [_get_inherited(impl, 'version') for impl in feed_root.getElementsByTagNameNS(XMLNS_IFACE, 'implementation')]
+	versions = [model.parse_version(version) for version in versions if version]
+	if versions:
+		entry['version'] = model.format_version(max(versions))
+	return entry
+
+def _write_json(rel_path, data):
+	"""Write data to public/rel_path in compact form, unless it already contains exactly that."""
+	path = join('public', rel_path)
+	new_data = json.dumps(data, ensure_ascii = False, separators = (',', ':'), sort_keys = True).encode('utf-8') + b'\n'
+	if os.path.exists(path):
+		with open(path, 'rb') as stream:
+			if stream.read() == new_data:
+				return
+	with open(path + '.new', 'wb') as stream:
+		stream.write(new_data)
+	support.portable_rename(path + '.new', path)
 
-	if need_update:
-		path_to_resources = relpath('resources', dir_rel_path).replace(os.sep, '/').encode()
-		new_data = build.sign_xml(config, (catalog_header % path_to_resources) + cat_doc.documentElement.toxml(encoding = 'utf-8') + b'\n')
-		with open(catalog_file + '.new', 'wb') as stream:
-			stream.write(new_data)
-		support.portable_rename(catalog_file + '.new', catalog_file)
-		print("Updated " + catalog_file)
+def write_index(config, catalog_rel_path, entries, old_index_files):
+	"""Write the search index for DIR/NAME.xml as DIR/NAME.json (plus NAME.N.json chunks if there are more than
+	config.CATALOG_INDEX_CHUNK_SIZE entries). Files are only written if they changed. Chunks no longer
+	needed are deleted. Returns the index files, relative to 'public'."""
+	chunk_size = getattr(config, 'CATALOG_INDEX_CHUNK_SIZE', 500)
+	chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)] or [[]]
+	dir_rel_path, catalog_name = os.path.split(catalog_rel_path[:-len('.xml')])
+	chunk_names = ['{name}.{n}.json'.format(name = catalog_name, n = n) for n in range(1, len(chunks))]
+
+	index_files = [join(dir_rel_path, catalog_name + '.json')]
+	_write_json(index_files[0], {'count': len(entries), 'items': chunks[0], 'chunks': chunk_names})
+	for name, chunk in zip(chunk_names, chunks[1:]):
+		index_files.append(join(dir_rel_path, name))
+		_write_json(index_files[-1], {'items': chunk})
+
+	for rel_path in old_index_files:
+		if rel_path not in index_files:
+			for old_path in [join('public', rel_path)] + [join('public', rel_path + '.' + ext) for ext in compress.encodings]:
+				if os.path.exists(old_path):
+					os.unlink(old_path)
+
+	return index_files
+
+def generate_catalog(config, feeds, dir_rel_path, public_hashes, get_summary, load_doc, catalog_rel_path = None):
+	"""Returns the path of the catalog file, its new (unsigned) contents (or None if it is unchanged),
+	and the FeedSummary of each feed in it. The catalog is written to public/catalog_rel_path
+	(default: dir_rel_path/catalog.xml).
+	The catalog is assembled from the feed summaries, unless one of them needs the full DOM treatment."""
+	is_excluded_from_catalog = getattr(config, 'is_excluded_from_catalog', None)
+
+	entries = []
+	for feed in feeds:
+		summary = get_summary(feed)
+		if is_excluded_from_catalog is None:
+			excluded = summary.excluded
+		else:
+			excluded = is_excluded_from_catalog(load_doc(feed).documentElement, dir_rel_path)
+		if not excluded:
+			entries.append((summary, feed))
+	entries.sort(key = lambda entry: entry[0].name)
 
-	return join(dir_rel_path, 'catalog.xml')
+	cat_doc, cat_ns, custom_tags = _new_catalog_doc(config)
+
+	if all(summary.xml is not None for summary, feed in entries):
+		cat_xml = cat_doc.documentElement.toxml(encoding = 'utf-8')
+		if entries:
+			assert cat_xml.endswith(b'/>'), cat_xml
+			cat_xml = cat_xml[:-2] + b'>' + ''.join(summary.xml for summary, feed in entries).encode('utf-8') + b'</c:catalog>'
+	else:
+		stats.count('catalogs built with DOM')
+		for summary, feed in entries:
+			cat_doc.documentElement.appendChild(_make_catalog_entry(cat_doc, cat_ns, custom_tags, load_doc(feed).documentElement))
+		cat_xml = cat_doc.documentElement.toxml(encoding = 'utf-8')
+
+	if catalog_rel_path is None:
+		catalog_rel_path = join(dir_rel_path, 'catalog.xml')
+	catalog_file = join('public', catalog_rel_path)
+
+	path_to_resources = relpath('resources', dirname(catalog_rel_path)).replace(os.sep, '/').encode()
+	new_xml = (catalog_header % path_to_resources) + cat_xml + b'\n'
+	need_update = _catalog_changed(catalog_file, new_xml, public_hashes)
+
+	summaries = [summary for summary, feed in entries]
+
+	if not need_update:
+		return catalog_file, None, summaries
+
+	return catalog_file, new_xml, summaries
+
+def generate_shard_index(config, shard_paths, public_hashes):
+	"""Returns the path of the root catalog and its new (unsigned) contents, or None if it is unchanged.
+	In sharded mode, the root catalog just contains a <c:shard href='...'/> for each shard."""
+	cat_doc, cat_ns, custom_tags = _new_catalog_doc(config)
+	for shard_path in shard_paths:
+		elem = cat_doc.createElementNS(XMLNS_CATALOG, 'c:shard')
+		elem.setAttribute('href', shard_path.replace(os.sep, '/'))
+		cat_doc.documentElement.appendChild(elem)
+
+	catalog_file = join('public', 'catalog.xml')
+	new_xml = (catalog_header % b'resources') + cat_doc.documentElement.toxml(encoding = 'utf-8') + b'\n'
+	if not _catalog_changed(catalog_file, new_xml, public_hashes):
+		return catalog_file, None
+	return catalog_file, new_xml
+
+def _catalog_changed(catalog_file, new_xml, public_hashes):
+	"""Check whether new_xml differs from the existing catalog_file (comparing hashes if possible)."""
+	if not os.path.exists(catalog_file):
+		return True
+	new_sha256 = hashlib.sha256(new_xml).hexdigest()
+	need_update = public_hashes.has_changed(relpath(catalog_file, 'public'), new_sha256)
+	if need_update is None:
+		stats.count('catalogs parsed')
+		with open(catalog_file, 'rb') as stream:
+			old_catalog = minidom.parse(stream)
+		new_catalog = minidom.parseString(new_xml)
+		need_update = not xmltools.nodes_equal(old_catalog.documentElement, new_catalog.documentElement)
+		if not need_update:
+			public_hashes.record(relpath(catalog_file, 'public'), new_sha256)
+	return need_update
@@ -11,7 +11,7 @@ from os.path import join, dirname, abspath
 
 import zeroinstall.injector.config
 from zeroinstall import SafeException
-from repo import archives
+from repo import archives, paths
 
 def main(argv):
 	parser = argparse.ArgumentParser(description='Manage a 0install repository.')
@@ -37,7 +37,19 @@ def main(argv):
 
 	subparsers.add_parser('reindex', help='update archives.db from archives directory')
 
-	subparsers.add_parser('update', help='process "incoming" and generate output files')
+	parser_update = subparsers.add_parser('update', help='process "incoming" and generate output files')
+	parser_update.add_argument('--full', help='regenerate all public feeds, even if their sources are unchanged', action='store_true')
+	parser_update.add_argument('-j', '--jobs', metavar='N', help='validate incoming feeds and generate feeds using N processes (default: one per CPU)',
+			   nargs='?', type=int, default=1, const=os.cpu_count())
+	parser_update.add_argument('--stats', help='report the time spent in each phase, and save it in cache/stats', action='store_true')
+
+	parser_watch = subparsers.add_parser('watch', help='keep running, and process new files in "incoming" as soon as they arrive')
+	parser_watch.add_argument('-j', '--jobs', metavar='N', help='validate incoming feeds and generate feeds using N processes (default: one per CPU)',
+			   nargs='?', type=int, default=1, const=os.cpu_count())
+	parser_watch.add_argument('--interval', metavar='SECONDS', help='how often to check "incoming" if inotify is unavailable (default: 2)',
+			   type=float, default=2)
+	parser_watch.add_argument('--settle', metavar='SECONDS', help='how long "incoming" must be unchanged before processing it (default: 1)',
+			   type=float, default=1)
 
 	parser_proxy = subparsers.add_parser('proxy', help='run a http proxy which serves all repository URLs directly from the "public" directory')
 	parser_proxy.add_argument('-p', '--port', help='the port to run the HTTP proxy on', default=8080, type=int)
@@ -92,6 +104,8 @@ def load_config():
 			setattr(config, setting, value + '/')
 
 	config.archive_db = archives.ArchiveDB("archives.db")
+	config.hash_cache = archives.HashCache(paths.get_cache_path('sha1-cache'), getattr(config, 'HASH_CACHE_VERIFY', 0))
+	config.digest_cache = archives.DigestCache(paths.get_cache_path('verified-digests'))
 
 	config.zconfig = zeroinstall.injector.config.load_config()
 
@@ -8,7 +8,7 @@ from os.path import abspath
 
 from zeroinstall.injector import qdom
 
-from repo import incoming, cmd, registry
+from repo import incoming, cmd, registry, scm
 from repo.cmd import update
 
 def handle(args):
@@ -30,9 +30,17 @@ def handle(args):
 	config = cmd.load_config()
 
 	messages = []
-	for feed in files:
-		print("Adding", feed)
-		msg, _ = incoming.process(config, feed, delete_on_success = False)
-		if msg:
-			messages.append(msg)
+	batch = scm.Batch('feeds') if getattr(config, 'BATCH_COMMITS', False) else None
+	try:
+		for feed in files:
+			print("Adding", feed)
+			msg, _ = incoming.process(config, feed, delete_on_success = False, batch = batch)
+			if msg:
+				messages.append(msg)
+		if batch is not None:
+			batch.commit(incoming.get_commit_key(config))
+	except:
+		if batch is not None:
+			batch.rollback()
+		raise
 	update.do_update(config, messages = messages)
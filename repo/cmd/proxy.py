@@ -2,13 +2,46 @@
 
 import os
 import traceback
-from repo import cmd
+from repo import cmd, compress
 
 from http.server import SimpleHTTPRequestHandler
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import urllib.request, urllib.error, urllib.parse
 from socketserver import ThreadingMixIn
 
+def preferred_extensions(accept_encoding):
+	"""Extensions of the compressed variants the client accepts, best first."""
+	accepted = set()
+	for item in accept_encoding.split(','):
+		parts = item.strip().split(';')
+		coding = parts[0].strip().lower()
+		q = 1.0
+		for param in parts[1:]:
+			name, _, value = param.partition('=')
+			if name.strip() == 'q':
+				try:
+					q = float(value)
+				except ValueError:
+					pass
+		if q > 0:
+			accepted.add(coding)
+	return [ext for ext in ('br', 'gz') if compress.encodings[ext] in accepted or '*' in accepted]
+
+def pick_variant(rel_path, accept_encoding):
+	"""The extension of the compressed variant of rel_path to send, or None to send the file itself.
+	Only feeds and catalogs have variants, and only ones at least as new as the file are used."""
+	if not rel_path.endswith(compress.compressed_types):
+		return None
+	mtime = os.stat(rel_path).st_mtime_ns
+	for extension in preferred_extensions(accept_encoding):
+		try:
+			info = os.stat(rel_path + '.' + extension)
+		except OSError:
+			continue
+		if info.st_mtime_ns >= mtime:
+			return extension
+	return None
+
 def handle(args):
 	cmd.find_config()
 	config = cmd.load_config()
@@ -45,7 +78,17 @@ def handle(args):
 								(public_prefix, full_path))
 
 					try:
-						headers = [('Content-Length', os.stat(rel_path).st_size)]
+						size = os.stat(rel_path).st_size
+						headers = [('Content-Length', size)]
+						extension = pick_variant(rel_path, self.headers.get('Accept-Encoding', ''))
+						if extension is not None:
+							compressed_size = os.stat(rel_path + '.' + extension).st_size
+							headers = [('Content-Length', compressed_size),
+								   ('Content-Encoding', compress.encodings[extension]),
+								   ('Vary', 'Accept-Encoding')]
+							self.log_message("Sending %s as %s (%d bytes instead of %d)",
+									 rel_path, compress.encodings[extension], compressed_size, size)
+							rel_path += '.' + extension
 						with open(rel_path, 'rb') as stream:
 							send(stream, headers)
 					except OSError:
@@ -33,7 +33,7 @@ def handle(args):
 
 			rel_path = relpath(join(root, f), '.')
 
-			sha1 = archives.get_sha1(rel_path)
+			sha1 = archives.get_sha1(rel_path, config)
 			new = archives.StoredArchive(url = config.ARCHIVES_BASE_URL + rel_path, sha1 = sha1)
 
 			existing = db.entries.get(f, None)
@@ -5,12 +5,11 @@
 
 import time
 import os
-import subprocess
-from os.path import join, abspath
+from os.path import join, abspath, dirname
 
 from zeroinstall.injector import model, qdom
 
-from repo import incoming, build, catalog, cmd
+from repo import incoming, build, catalog, cmd, paths, stats, scm
 
 DAY = 60 * 60 * 24
 TIME_TO_GRADUATE = 14 * DAY
@@ -18,15 +17,28 @@ TIME_TO_GRADUATE = 14 * DAY
 def handle(args):
 	cmd.find_config()
 	config = cmd.load_config()
-	messages = incoming.process_incoming_dir(config)
-	do_update(config, messages)
-
-def do_update(config, messages = None):
-	feeds, files = build.build_public_feeds(config)
+	if args.stats:
+		stats_path = join(paths.get_cache_path('stats'), time.strftime('update-%Y%m%d-%H%M%S.json'))
+	with stats.phase('total'):
+		with stats.phase('incoming'):
+			messages = incoming.process_incoming_dir(config, jobs = args.jobs)
+		do_update(config, messages, full = args.full, jobs = args.jobs)
+	if args.stats:
+		stats.report()
+		paths.ensure_dir(dirname(stats_path))
+		stats.save(stats_path)
+		print("Saved stats as {path}".format(path = stats_path))
+
+def do_update(config, messages = None, full = False, jobs = 1, check_all_feeds = True):
+	"""Generate and upload the public feeds and catalogs. Leaves the current directory as 'public'.
+	If check_all_feeds is False, only changed feeds are checked for old 'testing' releases."""
+	with stats.phase('build'):
+		feeds, files = build.build_public_feeds(config, full = full, jobs = jobs)
 
 	files += [f.public_rel_path for f in feeds]
 
-	files += catalog.write_catalogs(config, feeds)
+	with stats.phase('catalogs'):
+		files += catalog.write_catalogs(config, feeds, full = full)
 
 	feeds_dir = abspath('feeds')
 
@@ -36,7 +48,7 @@ def do_update(config, messages = None):
 	resources_dir = join('resources')
 	if not os.path.isdir(resources_dir):
 		os.mkdir(resources_dir)
-	for resource in ['catalog.xsl', 'catalog.xsl.de', 'catalog.css', 'list.min.js', 'feed.xsl', 'feed.xsl.de', 'feed.css']:
+	for resource in ['catalog.xsl', 'catalog.xsl.de', 'catalog.html', 'catalog.html.de', 'catalog.css', 'list.min.js', 'feed.xsl', 'feed.xsl.de', 'feed.css']:
 		target = join('resources', resource)
 		files.append(target)
 		if not os.path.exists(target):
@@ -48,16 +60,18 @@ def do_update(config, messages = None):
 
 	if not messages:
 		messages = ['0repo update']
-	config.upload_public_dir(files, message = ', '.join(messages))
+	with stats.phase('upload'):
+		config.upload_public_dir(files, message = ', '.join(messages))
 
-	out = subprocess.check_output(['git', 'status', '--porcelain'], cwd = feeds_dir, encoding = 'utf-8').strip('\n')
+	out = scm.get_status(feeds_dir).describe()
 	if out:
 		print("Note: you have uncommitted changes in {feeds}:".format(feeds = feeds_dir))
 		print(out)
 		print("Run 'git commit -a' from that directory to save your changes.")
 
 	if getattr(config, 'TRACK_TESTING_IMPLS', True):
-		graduation_check(feeds, feeds_dir)
+		with stats.phase('graduation-check'):
+			graduation_check(feeds if check_all_feeds else [f for f in feeds if f.changed], feeds_dir)
 
 def graduation_check(feeds, feeds_dir):
 	# Warn about releases that are still 'testing' a while after release
@@ -0,0 +1,137 @@
+# Copyright (C) 2013, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import os
+import time
+import traceback
+from os.path import join, basename
+
+from zeroinstall import SafeException, support
+
+from repo import cmd, incoming, archives, scm, stats
+from repo.cmd import update
+
+class PollingWatcher(object):
+	"""Checks the directory every 'interval' seconds."""
+	def __init__(self, path, interval):
+		self.interval = interval
+
+	def wait(self):
+		time.sleep(self.interval)
+
+class InotifyWatcher(object):
+	"""Waits for files in the directory to be written, moved in or deleted (needs the inotify_simple module)."""
+	def __init__(self, path, interval):
+		from inotify_simple import INotify, flags
+		self.interval = interval
+		self.inotify = INotify()
+		self.inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+
+	def wait(self):
+		# (the timeout means we still notice changes made while we were busy)
+		self.inotify.read(timeout = int(self.interval * 1000))
+
+def make_watcher(path, interval):
+	if os.name != 'nt':
+		try:
+			return InotifyWatcher(path, interval)
+		except ImportError:
+			pass
+	print("(inotify_simple module not available; polling {path} every {interval} seconds)".format(path = path, interval = interval))
+	return PollingWatcher(path, interval)
+
+def get_snapshot(path):
+	"""Name -> (size, mtime) for each file in path."""
+	snapshot = {}
+	for name in os.listdir(path):
+		try:
+			info = os.stat(os.path.join(path, name))
+		except OSError:
+			continue	# Deleted while we were looking
+		snapshot[name] = (info.st_size, info.st_mtime_ns)
+	return snapshot
+
+def get_stat(path):
+	try:
+		info = os.stat(path)
+	except OSError:
+		return None
+	return (info.st_size, info.st_mtime_ns)
+
+def handle(args):
+	cmd.find_config()
+	config = cmd.load_config()
+	repo_dir = os.getcwd()
+
+	os.makedirs('incoming', exist_ok = True)
+	watcher = make_watcher('incoming', args.interval)
+
+	archives_db_stat = get_stat('archives.db')
+
+	def reject(xml_file):
+		"""Move a rejected feed out of the way, so that it doesn't hold up later releases."""
+		rejected_dir = join('incoming', 'rejected')
+		os.makedirs(rejected_dir, exist_ok = True)
+		target = join(rejected_dir, basename(xml_file))
+		support.portable_rename(xml_file, target)
+		print("Moved {feed} to {target}".format(feed = xml_file, target = target))
+
+	def process_incoming():
+		"""Process the incoming feeds, setting aside any that are rejected.
+		Returns the commit messages for the feeds that were committed."""
+		messages = []
+		while True:
+			try:
+				return messages + incoming.process_incoming_dir(config, jobs = args.jobs)
+			except incoming.RejectedFeed as ex:
+				print(ex)
+				messages += ex.messages
+				reject(ex.xml_file)
+
+	def run_update(check_all_feeds):
+		nonlocal archives_db_stat
+		if get_stat('archives.db') != archives_db_stat:
+			# Changed by something else (e.g. '0repo reindex')
+			config.archive_db = archives.ArchiveDB('archives.db')
+		scm.forget_status()		# (the feeds may have been edited since the last run)
+		stats.reset()			# (report on this run only)
+		messages = []
+		try:
+			messages = process_incoming()
+		except SafeException as ex:
+			print(ex)
+		except Exception:
+			traceback.print_exc()
+		try:
+			# (publish whatever was committed, even if something failed part way through)
+			update.do_update(config, messages, jobs = args.jobs, check_all_feeds = check_all_feeds)
+		except SafeException as ex:
+			print(ex)
+		except Exception:
+			traceback.print_exc()
+		finally:
+			os.chdir(repo_dir)
+			archives_db_stat = get_stat('archives.db')
+
+	print("Watching {path} for new releases (press Ctrl-C to stop)...".format(path = os.path.abspath('incoming')))
+	# (snapshot before processing, so that files uploaded while we're busy still get noticed)
+	last_processed = get_snapshot('incoming')
+	run_update(check_all_feeds = True)
+	try:
+		while True:
+			watcher.wait()
+			snapshot = get_snapshot('incoming')
+			if snapshot == last_processed or not any(name.endswith('.xml') for name in snapshot):
+				continue
+
+			# Wait until the uploader seems to have finished
+			time.sleep(args.settle)
+			if get_snapshot('incoming') != snapshot:
+				continue
+
+			print("Processing new files in incoming...")
+			# (if processing fails, wait for something to change before trying again)
+			last_processed = snapshot
+			run_update(check_all_feeds = False)
+	except KeyboardInterrupt:
+		print("Stopped watching")
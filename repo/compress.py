@@ -0,0 +1,71 @@
+# Copyright (C) 2013, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import os, gzip
+from os.path import join
+
+from zeroinstall import SafeException, support
+
+from repo import stats
+
+# File extension -> Content-Encoding
+encodings = {
+	'gz': 'gzip',
+	'br': 'br',
+}
+
+# Only the files we generate with these extensions get compressed variants
+compressed_types = ('.xml', '.json')
+
+def _compress(extension, data):
+	if extension == 'gz':
+		# mtime = 0 so that the output only changes when the data does
+		return gzip.compress(data, compresslevel = 9, mtime = 0)
+	else:
+		import brotli
+		return brotli.compress(data)
+
+def get_extensions(config):
+	"""The compressed variants to generate (e.g. ['gz', 'br']), from config.COMPRESS_PUBLIC_FILES."""
+	extensions = getattr(config, 'COMPRESS_PUBLIC_FILES', [])
+	for extension in extensions:
+		if extension not in encodings:
+			raise SafeException("Unknown compression '{ext}' in COMPRESS_PUBLIC_FILES (should be one of: {known})".format(
+				ext = extension, known = ', '.join(sorted(encodings))))
+		if extension == 'br':
+			try:
+				import brotli
+			except ImportError:
+				raise SafeException("COMPRESS_PUBLIC_FILES includes 'br', but the brotli Python module is not installed")
+	return extensions
+
+def update_compressed(config, rel_path):
+	"""Ensure each configured compressed variant of public/rel_path exists and is at least as new as it,
+	and delete any variants which are no longer configured.
+	Returns the variants' paths, relative to 'public'."""
+	extensions = get_extensions(config)
+	path = join('public', rel_path)
+	for extension in encodings:
+		if extension not in extensions and os.path.exists(path + '.' + extension):
+			os.unlink(path + '.' + extension)
+	if not extensions:
+		return []
+	mtime = os.stat(path).st_mtime_ns
+	data = None
+	variants = []
+	for extension in extensions:
+		variant_path = path + '.' + extension
+		try:
+			up_to_date = os.stat(variant_path).st_mtime_ns >= mtime
+		except OSError:
+			up_to_date = False
+		if not up_to_date:
+			if data is None:
+				with open(path, 'rb') as stream:
+					data = stream.read()
+			with open(variant_path + '.new', 'wb') as stream:
+				stream.write(_compress(extension, data))
+			support.portable_rename(variant_path + '.new', variant_path)
+			stats.count('compressed variants written')
+		variants.append(rel_path + '.' + extension)
+	return variants
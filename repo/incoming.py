@@ -3,7 +3,7 @@
 
 
 
-import os, subprocess
+import os, subprocess, hashlib, collections
 from io import BytesIO
 from os.path import join, dirname, basename, relpath
 from xml.dom import minidom, Node
@@ -12,7 +12,7 @@ from zeroinstall.injector import qdom, model, gpg
 from zeroinstall.injector.namespaces import XMLNS_IFACE
 from zeroinstall import SafeException, support
 
-from repo import paths, archives, scm, merge, formatting
+from repo import paths, archives, scm, merge, formatting, stats, signing, cache
 
 def get_feed_url(root, path):
 	uri = root.attrs.get('uri', None)
@@ -29,8 +29,49 @@ def get_feed_url(root, path):
 	else:
 		raise SafeException("Missing <feed-for>/uri in " + path)
 
+class RejectedFeed(SafeException):
+	"""Raised by process_incoming_dir when the checks fail for one of the incoming feeds.
+	'messages' are the commit messages for the feeds that were committed before it."""
+	def __init__(self, xml_file, ex, messages):
+		SafeException.__init__(self, str(ex))
+		self.xml_file = xml_file
+		self.messages = messages
+
+ImportedFeed = collections.namedtuple('ImportedFeed', ['commit', 'feed', 'subject'])
+
+class ImportIndex(object):
+	"""Records the SHA-256 of each incoming feed we have committed, with the commit, the feed it went
+	into (relative to 'feeds') and the commit's subject. This lets us recognise a feed that was already
+	merged without searching the Git log. Each line of the file is 'SHA256 COMMIT FEED SUBJECT',
+	separated by tabs; new entries are appended."""
+	def __init__(self, path):
+		self.records = cache.RecordFile(path, 4, separator = '\t')
+		self.entries = {}	# SHA-256 -> ImportedFeed
+		for sha256, commit, feed, subject in self.records.read():
+			self.entries[sha256] = ImportedFeed(commit, feed, subject)
+
+	def lookup(self, sha256):
+		return self.entries.get(sha256, None)
+
+	def add(self, sha256, commit, feed, subject):
+		self.records.append([sha256, commit, feed, subject])
+		self.entries[sha256] = ImportedFeed(commit, feed, subject)
+
+def get_import_index(config):
+	"""The ImportIndex for this repository (in /imported-feeds), loaded on first use.
+	It can't be rebuilt, so it isn't kept in 'cache' (older versions of 0repo put it there)."""
+	index = getattr(config, 'import_index', None)
+	if index is None:
+		path = os.path.abspath('imported-feeds')
+		old_path = join('cache', 'imported-feeds')
+		if not os.path.exists(path) and os.path.exists(old_path):
+			support.portable_rename(old_path, path)
+		index = config.import_index = ImportIndex(path)
+	return index
+
 def get_last_commit(feed_path):
 	"""Get the (subject, XML) of the last commit."""
+	stats.count('git processes')
 	msg, body = subprocess.check_output(['git', 'log', '-n', '1', '--pretty=format:%s%n%b', '--', feed_path], cwd = 'feeds').split(b'\n',1)
 	return (msg.decode(), body)
 
@@ -75,18 +116,29 @@ def ask_if_previous_still_testing(master_doc, new_version):
 		if impl.getAttribute('id') in ids_to_change:
 			impl.setAttribute('stability', 'stable')
 
-def process(config, xml_file, delete_on_success):
-	"""Import xml_file into the repository.
-	   On success, returns a summary message and the list of archive paths (in incoming) used."""
-
-	# Step 1 : check everything looks sensible, reject if not
-
+def load_incoming(config, xml_file, validated = None, prechecked = None):
+	"""Read an incoming feed and check its signatures and the repository's check_new_impl policy.
+	If validated is the SHA-256 that validate() returned for this file, these checks (and the digest checks)
+	have already passed and are skipped. If prechecked is the SHA-256 that precheck() returned, only these
+	checks are skipped.
+	Returns (xml_text, sig_index, root, feed, master, import_master, checked), where checked is False if the
+	digests have already been checked."""
 	with open(xml_file, 'rb') as stream:
 		xml_text = stream.read()
+		xml_sha256 = hashlib.sha256(xml_text).hexdigest()
+		checked = validated is None or xml_sha256 != validated
+		trusted = not checked or xml_sha256 == prechecked
+		verification_cache = None if trusted else signing.get_verification_cache(config)
+		sigs = None		# (stays None if we don't need to check them)
 		sig_index = xml_text.rfind(b'\n<!-- Base64 Signature')
 		if sig_index != -1:
-			stream.seek(0)
-			stream, sigs = gpg.check_stream(stream)
+			if verification_cache is not None and verification_cache.lookup(xml_text):
+				stats.count('signature checks reused')
+			elif not trusted:
+				stream.seek(0)
+				with stats.phase('incoming/signatures'):
+					stats.count('gpg processes')
+					stream, sigs = gpg.check_stream(stream)
 		else:
 			sig_index = len(xml_text)
 			sigs = []
@@ -99,23 +151,84 @@ def process(config, xml_file, delete_on_success):
 		root.attrs['uri'] = master	# (hack so we can parse it here without setting local_path)
 
 	# Check signatures are valid
-	if config.CONTRIBUTOR_GPG_KEYS is not None:
-		for sig in sigs:
-			if isinstance(sig, gpg.ValidSig) and sig.fingerprint in config.CONTRIBUTOR_GPG_KEYS:
-				break
-		else:
-			raise SafeException("No trusted signatures on feed {path}; signatures were: {sigs}".format(
-				path = xml_file,
-				sigs = ', '.join([str(s) for s in sigs])))
+	if not trusted and sigs is not None:
+		if config.CONTRIBUTOR_GPG_KEYS is not None:
+			for sig in sigs:
+				if isinstance(sig, gpg.ValidSig) and sig.fingerprint in config.CONTRIBUTOR_GPG_KEYS:
+					break
+			else:
+				stats.count('incoming rejected at signatures')
+				raise SafeException("No trusted signatures on feed {path}; signatures were: {sigs}".format(
+					path = xml_file,
+					sigs = ', '.join([str(s) for s in sigs])))
+		if sigs and verification_cache is not None:
+			verification_cache.add(xml_text)
 
 	feed = model.ZeroInstallFeed(root)
 
 	# Perform custom checks defined by the repository owner
-	for impl in list(feed.implementations.values()):
-		problem = config.check_new_impl(impl)
-		if problem:
-			raise SafeException("{problem} in {xml_file}\n(this check was configured in {config}: check_new_impl())".format(
-				problem = problem, xml_file = xml_file, config = config.__file__))
+	if not trusted:
+		for impl in list(feed.implementations.values()):
+			with stats.phase('incoming/checks'):
+				problem = config.check_new_impl(impl)
+			if problem:
+				stats.count('incoming rejected at policy')
+				raise SafeException("{problem} in {xml_file}\n(this check was configured in {config}: check_new_impl())".format(
+					problem = problem, xml_file = xml_file, config = config.__file__))
+
+	return xml_text, sig_index, root, feed, master, import_master, checked
+
+def get_previous_import(config, xml_sha256, git_path):
+	"""The ImportedFeed recording that this incoming feed was already merged into git_path, if any."""
+	previous = get_import_index(config).lookup(xml_sha256)
+	if previous is not None and previous.feed == git_path:
+		return previous
+	return None
+
+def precheck(config, xml_file):
+	"""Do the cheap checks on an incoming feed: its signatures and check_new_impl (see load_incoming),
+	then the cheap checks on its archives (see archives.check_incoming_archives). Feeds we have already
+	merged are skipped (their archives may be gone from incoming), leaving process() to report them.
+	Returns the SHA-256 of the file, to pass to validate() or process() so that they don't check the
+	signatures and policy again."""
+	xml_text, sig_index, root, feed, master, import_master, checked = load_incoming(config, xml_file)
+	xml_sha256 = hashlib.sha256(xml_text).hexdigest()
+	git_path = paths.get_feeds_rel_path(config, master)
+	feed_exists = os.path.exists(join('feeds', git_path))
+	if import_master:
+		if feed_exists:
+			return xml_sha256	# (process() will skip it, or refuse to replace the existing feed)
+	elif get_previous_import(config, xml_sha256, git_path) is not None:
+		return xml_sha256
+	try:
+		archives.check_incoming_archives(config, dirname(xml_file), feed)
+	except SafeException:
+		# Merged by an older version of 0repo, which didn't record it in the ImportIndex?
+		if feed_exists and xml_text in get_last_commit(git_path)[1]:
+			return xml_sha256
+		raise
+	return xml_sha256
+
+def validate(config, xml_file, prechecked = None):
+	"""Do the checks on an incoming feed which don't depend on (or change) the state of the repository:
+	signatures, check_new_impl and the archives' digests. These are independent for each feed, so several
+	feeds can be validated at once. prechecked is as for load_incoming.
+	Returns the SHA-256 of the file, to pass to process()."""
+	xml_text, sig_index, root, feed, master, import_master, checked = load_incoming(config, xml_file, prechecked = prechecked)
+	archives.check_incoming_digests(config, dirname(xml_file), feed)
+	return hashlib.sha256(xml_text).hexdigest()
+
+def process(config, xml_file, delete_on_success, validated = None, batch = None, prechecked = None):
+	"""Import xml_file into the repository.
+	   If validated is the result of validate() on this file, its checks aren't repeated.
+	   If prechecked is the result of precheck(), the signatures and policy aren't checked again.
+	   If batch is an scm.Batch, the change is added to it rather than committed.
+	   On success, returns a summary message and the list of archive paths (in incoming) used."""
+
+	# Step 1 : check everything looks sensible, reject if not
+
+	xml_text, sig_index, root, feed, master, import_master, checked = load_incoming(config, xml_file, validated, prechecked)
+	xml_sha256 = hashlib.sha256(xml_text).hexdigest()
 
 	feeds_rel_path = paths.get_feeds_rel_path(config, master)
 	feed_path = join("feeds", feeds_rel_path)
@@ -123,7 +236,7 @@ def process(config, xml_file, delete_on_success):
 	if not os.path.isdir(feed_dir):
 		os.makedirs(feed_dir)
 
-	scm.ensure_no_uncommitted_changes(feed_path)
+	scm.ensure_no_uncommitted_changes(feed_path, batch)
 
 	if import_master:
 		if os.path.exists(feed_path):
@@ -165,11 +278,17 @@ def process(config, xml_file, delete_on_success):
 	else:
 		# Merge into existing feed
 		try:
-			new_doc = merge.merge_files(master, feed_path, xml_file)
+			with stats.phase('incoming/merge'):
+				new_doc = merge.merge_files(master, feed_path, xml_file)
 		except merge.DuplicateIDException as ex:
-			# Did we already import this XML? Compare with the last Git log entry.
+			# Did we already import this XML?
+			previous = get_previous_import(config, xml_sha256, git_path)
+			if previous is not None:
+				print("Already merged this into {feed} (in commit {commit}); skipping".format(feed = feed_path, commit = previous.commit[:12]))
+				return previous.subject, []
+			# Not in the index (e.g. imported by an older version of 0repo). Compare with the last Git log entry.
 			msg, previous_commit_xml = get_last_commit(git_path)
-			if previous_commit_xml == xml_text:
+			if xml_text in previous_commit_xml:	# (may have been committed as part of a batch)
 				print("Already merged this into {feed}; skipping".format(feed = feed_path))
 				return msg, []
 			raise ex
@@ -178,7 +297,8 @@ def process(config, xml_file, delete_on_success):
 
 	# Step 2 : upload archives to hosting
 
-	processed_archives = archives.process_archives(config, incoming_dir = dirname(xml_file), feed = feed)
+	with stats.phase('incoming/archives'):
+		processed_archives = archives.process_archives(config, incoming_dir = dirname(xml_file), feed = feed, check_digests = checked)
 
 	# Step 3 : merge XML into feeds directory
 
@@ -189,7 +309,8 @@ def process(config, xml_file, delete_on_success):
 			ask_if_previous_still_testing(new_doc, list(new_versions)[0])
 		new_xml = formatting.format_doc(new_doc)
 
-	write_to_git(feed_path, new_xml, commit_msg, config, new_file)
+	with stats.phase('incoming/commit'):
+		write_to_git(feed_path, new_xml, commit_msg, config, new_file, batch, xml_sha256)
 
 	# Delete XML from incoming directory
 	if delete_on_success:
@@ -197,8 +318,34 @@ def process(config, xml_file, delete_on_success):
 
 	return commit_msg.split('\n', 1)[0], [archive.incoming_path for archive in processed_archives]
 
-def process_incoming_dir(config):
-	"""Current directory contains 'incoming'."""
+_worker_config = None		# Set in the parent before forking validation workers
+
+def _validate_in_worker(item):
+	xml_file, prechecked = item
+	try:
+		return validate(_worker_config, xml_file, prechecked)
+	except Exception:
+		return None		# The parent will repeat the checks and report the error
+
+def _validate_in_parallel(config, xml_files, prechecked, jobs):
+	"""Run validate() on each file (with the corresponding prechecked SHA-256) in a pool of 'jobs' processes.
+	Yields the results in order, as they become available (None if validation failed)."""
+	global _worker_config
+	import multiprocessing
+	_worker_config = config
+	try:
+		with multiprocessing.get_context('fork').Pool(jobs) as pool:
+			yield from pool.imap(_validate_in_worker, zip(xml_files, prechecked))
+	finally:
+		_worker_config = None
+
+def process_incoming_dir(config, jobs = 1):
+	"""Current directory contains 'incoming'.
+	The cheap checks (see precheck) are done on all the incoming feeds first, so that a bad feed is
+	rejected before we copy, unpack or upload anything for the others.
+	If jobs > 1, the incoming feeds are validated in that many worker processes, while this
+	process merges and commits them one at a time, in order.
+	If a feed is rejected, raises RejectedFeed."""
 	os.makedirs('incoming', exist_ok=True)
 	incoming_files = os.listdir('incoming')
 	new_xml = []
@@ -210,13 +357,48 @@ def process_incoming_dir(config):
 	archive_paths = set()
 
 	if new_xml:
-		for xml in sorted(new_xml):
-			print("Processing", xml)
-			msg, paths = process(config, os.path.join('incoming', xml), delete_on_success = True)
-			if msg:
-				messages.append(msg)
-			for path in paths:
-				archive_paths.add(path)
+		xml_files = [os.path.join('incoming', xml) for xml in sorted(new_xml)]
+		prechecked = []
+		with stats.phase('incoming/prechecks'):
+			for xml_file in xml_files:
+				try:
+					prechecked.append(precheck(config, xml_file))
+				except SafeException as ex:
+					raise RejectedFeed(xml_file, ex, []) from ex
+		if jobs > 1 and len(xml_files) > 1 and os.name != 'nt':
+			validated = _validate_in_parallel(config, xml_files, prechecked, jobs)
+		else:
+			validated = (None for xml_file in xml_files)
+		batch = scm.Batch('feeds') if getattr(config, 'BATCH_COMMITS', False) else None
+		try:
+			for xml_file, sha256, prechecked_sha256 in zip(xml_files, validated, prechecked):
+				print("Processing", basename(xml_file))
+				try:
+					msg, paths = process(config, xml_file, delete_on_success = batch is None, validated = sha256,
+							     batch = batch, prechecked = prechecked_sha256)
+				except SafeException as ex:
+					# (with a batch, nothing will have been committed)
+					raise RejectedFeed(xml_file, ex, messages if batch is None else []) from ex
+				stats.count('incoming feeds processed')
+				if msg:
+					messages.append(msg)
+				for path in paths:
+					archive_paths.add(path)
+			if batch is not None:
+				with stats.phase('incoming/commit'):
+					batch.commit(get_commit_key(config))
+		except:
+			if batch is not None:
+				batch.rollback()
+			raise
+		finally:
+			validated.close()	# (stops any remaining workers if we failed)
+
+		if batch is not None:
+			# Only delete the incoming feeds once they're committed
+			for xml_file in xml_files:
+				if os.path.exists(xml_file):
+					os.unlink(xml_file)
 	else:
 		pass #print('No .xml files in "incoming" directory (nothing to process)')
 
@@ -253,9 +435,27 @@ def create_from_local(master_feed_url, new_impls_feed):
 	
 	return formatting.format_doc(doc)
 
-def write_to_git(feed_path, new_xml, commit_msg, config, new_file = False):
+def get_commit_key(config):
+	return config.GPG_SIGNING_KEY if getattr(config, 'SIGN_COMMITS', True) else None
+
+def write_to_git(feed_path, new_xml, commit_msg, config, new_file = False, batch = None, xml_sha256 = None):
+	"""Write new_xml to feed_path and commit it. If batch is given, just add it to that instead.
+	xml_sha256 is the SHA-256 of the incoming feed being imported, if any, to record in the ImportIndex."""
 	did_git_add = False
 	git_path = relpath(feed_path, 'feeds')
+	subject = commit_msg.split('\n', 1)[0]
+
+	def record_import(commit_id):
+		if xml_sha256 is not None:
+			get_import_index(config).add(xml_sha256, commit_id, git_path, subject)
+
+	if batch is not None:
+		batch.add(git_path, new_file, commit_msg)
+		batch.on_commit.append(record_import)
+		with open(feed_path + '.new', 'wb') as stream:
+			stream.write(new_xml)
+		support.portable_rename(feed_path + '.new', feed_path)
+		return
 
 	try:
 		with open(feed_path + '.new', 'wb') as stream:
@@ -264,11 +464,12 @@ def write_to_git(feed_path, new_xml, commit_msg, config, new_file = False):
 
 		# Commit
 		if new_file:
+			stats.count('git processes')
 			subprocess.check_call(['git', 'add', git_path], cwd = 'feeds')
 			did_git_add = True
 
 		# (this must be last in the try block)
-		scm.commit('feeds', [git_path], commit_msg, key = config.GPG_SIGNING_KEY if getattr(config, 'SIGN_COMMITS', True) else None)
+		commit_id = scm.commit('feeds', [git_path], commit_msg, key = get_commit_key(config))
 	except Exception as ex:
 		# Roll-back (we didn't commit to Git yet)
 		print(ex)
@@ -281,3 +482,5 @@ def write_to_git(feed_path, new_xml, commit_msg, config, new_file = False):
 		else:
 			subprocess.check_call(['git', 'checkout', 'HEAD', '--', git_path], cwd = 'feeds')
 		raise
+
+	record_import(commit_id)
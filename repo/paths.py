@@ -1,7 +1,7 @@
 # Copyright (C) 2013, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-from os.path import isabs, dirname
+from os.path import isabs, dirname, abspath, join
 import os
 import collections
 
@@ -11,6 +11,12 @@ def ensure_dir(path):
 	if not os.path.isdir(path):
 		os.makedirs(path)
 
+def get_cache_path(name):
+	"""Return the absolute path of 'name' within the repository's 'cache' directory.
+	Must be called from the root of the repository."""
+	ensure_dir('cache')
+	return abspath(join('cache', name))
+
 def group_by_target_url_dir(archives):
 	results = collections.defaultdict(lambda: [])		# rel_url -> [basename]
 	for archive in archives:
@@ -3,16 +3,77 @@
 
 
 
-import os, subprocess
-from os.path import dirname, abspath
+import os, subprocess, collections
+from os.path import dirname, abspath, join, relpath
 
 from zeroinstall import SafeException
 
-def ensure_no_uncommitted_changes(path):
-	child = subprocess.Popen(["git", "diff", "--exit-code", "HEAD", "--", abspath(path)], cwd = dirname(path), stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-	stdout, unused = child.communicate()
-	if child.returncode == 0:
+from repo import stats
+
+class Status(object):
+	"""A snapshot of 'git status' for the directory 'cwd' (which need not be the top-level directory
+	of its Git repository). Git is only run once; our own commits then update the snapshot."""
+	def __init__(self, cwd):
+		self.cwd = cwd
+		self.entries = collections.OrderedDict()	# Path relative to cwd -> (XY status code, original path or None)
+		stats.count('git processes', 2)
+		# (git status always reports paths relative to the top-level directory)
+		prefix = subprocess.check_output(['git', 'rev-parse', '--show-prefix'], cwd = cwd).decode('utf-8', 'surrogateescape').strip('\n')
+		out = subprocess.check_output(['git', 'status', '-z', '--porcelain', '--', '.'], cwd = cwd)
+		fields = iter(out.decode('utf-8', 'surrogateescape').split('\0'))
+		def strip_prefix(path):
+			return path[len(prefix):] if path.startswith(prefix) else path
+		for field in fields:
+			if not field: continue
+			code, path = field[:2], field[3:]
+			orig = next(fields) if code[0] in 'RC' else None	# (renames and copies are followed by the old path)
+			self.entries[strip_prefix(path)] = (code, orig and strip_prefix(orig))
+
+	def is_changed(self, path):
+		"""Whether the tracked file 'path' (relative to the current directory) differs from HEAD.
+		Untracked files don't count."""
+		entry = self.entries.get(relpath(abspath(path), self.cwd), None)
+		return entry is not None and entry[0] != '??'
+
+	def forget(self, paths):
+		"""Record that 'paths' (relative to cwd) now match HEAD."""
+		for path in paths:
+			self.entries.pop(path, None)
+
+	def describe(self):
+		"""All the changes, in the format of 'git status --porcelain'."""
+		lines = []
+		for path, (code, orig) in self.entries.items():
+			if orig is not None:
+				path = '{orig} -> {path}'.format(orig = orig, path = path)
+			lines.append('{code} {path}'.format(code = code, path = path))
+		return '\n'.join(lines)
+
+_snapshots = {}		# Absolute path of repository -> Status
+
+def get_status(cwd):
+	"""The Status of the Git repository 'cwd', reusing the snapshot taken earlier in this run if there is one."""
+	key = abspath(cwd)
+	status = _snapshots.get(key, None)
+	if status is None:
+		status = _snapshots[key] = Status(key)
+	return status
+
+def forget_status():
+	"""Discard the snapshots, so that the next check runs 'git status' again (e.g. for the next run of '0repo watch')."""
+	_snapshots.clear()
+
+def ensure_no_uncommitted_changes(path, batch = None, cwd = 'feeds'):
+	"""Raise an exception if path has been changed since the last commit (other than by 'batch').
+	cwd is a directory in the Git repository containing path."""
+	if batch is not None and batch.includes(path):
 		return
+	if not get_status(cwd).is_changed(path):
+		return
+
+	stats.count('git processes')
+	child = subprocess.Popen(["git", "diff", "HEAD", "--", abspath(path)], cwd = dirname(abspath(path)), stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+	stdout, unused = child.communicate()
 
 	raise SafeException('Uncommitted changes in {feed}!\n'
 			    'In the feeds directory, use:\n\n'
@@ -21,6 +82,7 @@ def ensure_no_uncommitted_changes(path):
 			    'Changes are:\n{changes}'.format(feed = path, changes = stdout))
 
 def uid_from_fingerprint(keyid):
+	stats.count('gpg processes')
 	keys = subprocess.check_output(['gpg', '-q', '--fixed-list-mode', '--with-colons', '--list-secret-keys', keyid], encoding='utf-8')
 	for line in keys.split('\n'):
 		bits = line.split(':')
@@ -33,6 +95,7 @@ def uid_from_fingerprint(keyid):
 		raise SafeException("GPG key not found: " + keys)
 
 def commit(cwd, paths, msg, key, extra_options = []):
+	"""Commit 'paths' in the Git repository in 'cwd'. Returns the ID of the new commit."""
 	env = os.environ.copy()
 
 	gpg_override_applied = False
@@ -53,11 +116,91 @@ def commit(cwd, paths, msg, key, extra_options = []):
 	try:
 		msg_file.write(msg.encode('utf-8'))
 		msg_file.close()
+		stats.count('git processes')
 		subprocess.check_call(['git', 'commit', '-q', '-F', msg_file.name] + (['-S' + key] if key else []) + extra_options + ['--'] + paths,
 				      cwd = cwd,
 				      env = env)
+		status = _snapshots.get(abspath(cwd), None)
+		if status is not None:
+			status.forget(paths)
+		stats.count('git processes')
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = cwd, encoding = 'utf-8').strip()
 	finally:
 		if gpg_override_applied:
 			subprocess.check_call(['git', 'config', '--unset', 'gpg.program'], cwd = cwd)
 		msg_file.close()
 		os.remove(msg_file.name)
+
+class Batch(object):
+	"""A set of changes to files in the Git repository in 'cwd', to be committed together at the end
+	(or rolled back, leaving the repository as it was)."""
+	def __init__(self, cwd):
+		self.cwd = cwd
+		self.paths = []		# Paths (relative to cwd) changed, in order
+		self.new_paths = set()	# Paths which didn't exist in Git before
+		self.messages = []
+		self.on_commit = []	# Functions to call with the commit ID once committed
+
+	def includes(self, path):
+		"""Whether the batch has changed 'path' (relative to the current directory)."""
+		return any(abspath(join(self.cwd, p)) == abspath(path) for p in self.paths)
+
+	def add(self, path, new_file, msg):
+		"""Record that we're about to change 'path' (relative to cwd). Call this before modifying the file."""
+		if path not in self.paths:
+			self.paths.append(path)
+			if new_file:
+				self.new_paths.add(path)
+		self.messages.append(msg)
+
+	def commit(self, key):
+		"""Commit all the changes as one commit. Rolls back on failure.
+		Returns the ID of the new commit (None if there was nothing to commit)."""
+		if not self.paths:
+			return None
+		if len(self.messages) == 1:
+			msg = self.messages[0]
+		else:
+			subjects = [m.split('\n', 1)[0] for m in self.messages]
+			msg = '{n} changes: {subjects}\n\n{details}'.format(
+				n = len(self.messages),
+				subjects = '; '.join(subjects),
+				details = '\n\n'.join(self.messages))
+		try:
+			new_paths = [p for p in self.paths if p in self.new_paths]
+			if new_paths:
+				stats.count('git processes')
+				subprocess.check_call(['git', 'add', '--'] + new_paths, cwd = self.cwd)
+			commit_id = commit(self.cwd, self.paths, msg, key)
+		except Exception:
+			self.rollback()
+			raise
+		on_commit = self.on_commit
+		self.paths = []
+		self.new_paths = set()
+		self.messages = []
+		self.on_commit = []
+		for fn in on_commit:
+			fn(commit_id)
+		return commit_id
+
+	def rollback(self):
+		"""Undo all changes made in this batch."""
+		if not self.paths:
+			return
+		print("Rolling back changes to {paths}...".format(paths = ', '.join(self.paths)))
+		new_paths = [p for p in self.paths if p in self.new_paths]
+		old_paths = [p for p in self.paths if p not in self.new_paths]
+		if new_paths:
+			stats.count('git processes')
+			subprocess.check_call(['git', 'rm', '-q', '--cached', '--ignore-unmatch', '--'] + new_paths, cwd = self.cwd)
+			for p in new_paths:
+				if os.path.exists(join(self.cwd, p)):
+					os.unlink(join(self.cwd, p))
+		if old_paths:
+			stats.count('git processes')
+			subprocess.check_call(['git', 'checkout', 'HEAD', '--'] + old_paths, cwd = self.cwd)
+		self.paths = []
+		self.new_paths = set()
+		self.messages = []
+		self.on_commit = []
@@ -0,0 +1,207 @@
+# Copyright (C) 2013, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import os, time, logging, hashlib, subprocess, json
+from os.path import join
+from concurrent import futures
+
+from zeroinstall import SafeException, support
+
+from repo import build, paths, stats
+
+class _LRUDirectory:
+	"""A directory of cache files ending in 'suffix', of which at most 'max_entries' are kept.
+	The least recently used ones (by mtime) are removed first."""
+	suffix = None
+
+	def __init__(self, dir, max_entries):
+		self.dir = dir
+		self.max_entries = max_entries
+		paths.ensure_dir(dir)
+
+	def expire(self):
+		entries = []
+		for name in os.listdir(self.dir):
+			if name.endswith(self.suffix):
+				try:
+					entries.append((os.stat(join(self.dir, name)).st_mtime, name))
+				except OSError:
+					pass	# (removed by another process)
+		if len(entries) <= self.max_entries:
+			return
+		entries.sort()
+		for mtime, name in entries[:len(entries) - self.max_entries]:
+			try:
+				os.unlink(join(self.dir, name))
+			except OSError:
+				pass
+
+class SignatureCache(_LRUDirectory):
+	"""Detached signatures we have made before, keyed by (signing key fingerprints, SHA-256 of the signed data).
+	If a file's unsigned contents are the same as something we signed earlier (e.g. after a revert,
+	or when regenerating 'public' from scratch), we can reuse the old signature instead of running gpg.
+	At most 'max_entries' signatures are kept; the least recently used ones are removed first."""
+	suffix = '.sig'
+
+	def __init__(self, dir, fingerprint, max_entries):
+		_LRUDirectory.__init__(self, dir, max_entries)
+		self.fingerprint = fingerprint
+
+	def _path(self, source_xml):
+		return join(self.dir, '%s-%s.sig' % (self.fingerprint, hashlib.sha256(source_xml).hexdigest()))
+
+	def lookup(self, source_xml):
+		path = self._path(source_xml)
+		try:
+			with open(path, 'rb') as stream:
+				signature = stream.read()
+		except OSError:
+			return None
+		os.utime(path)		# (mark as recently used)
+		return signature
+
+	def add(self, source_xml, signature):
+		path = self._path(source_xml)
+		with open(path + '.new', 'wb') as stream:
+			stream.write(signature)
+		support.portable_rename(path + '.new', path)
+
+class VerificationCache(_LRUDirectory):
+	"""Signed incoming files which we have already checked and found to have a trusted signature.
+	Entries are keyed by the SHA-256 of the file together with the 'context' (the trusted keys and the
+	state of the GPG keyring), so changing either invalidates them. Failed checks are never recorded."""
+	suffix = '.ok'
+
+	def __init__(self, dir, context, max_entries):
+		_LRUDirectory.__init__(self, dir, max_entries)
+		self.context = context
+
+	def _path(self, signed_xml):
+		digest = hashlib.sha256(self.context.encode('utf-8') + b'\0' + signed_xml).hexdigest()
+		return join(self.dir, digest + self.suffix)
+
+	def lookup(self, signed_xml):
+		path = self._path(signed_xml)
+		if not os.path.exists(path):
+			return False
+		os.utime(path)		# (mark as recently used)
+		return True
+
+	def add(self, signed_xml):
+		path = self._path(signed_xml)
+		with open(path + '.new', 'wb'):
+			pass
+		support.portable_rename(path + '.new', path)
+		self.expire()
+
+_keyring_files = ['pubring.kbx', 'pubring.gpg', join('public-keys.d', 'pubring.db')]	# (at least one must exist)
+_keyring_settings_files = ['trustdb.gpg', 'common.conf', 'gpg.conf']
+
+def get_keyring_state():
+	"""The size and mtime of the files in the GPG home directory which affect signature checks,
+	or None if we can't find the keyring (e.g. a newer GnuPG storing it somewhere else)."""
+	gpg_home = os.environ.get('GNUPGHOME', None) or os.path.expanduser('~/.gnupg')
+	state = []
+	for name in _keyring_files + _keyring_settings_files:
+		try:
+			info = os.stat(join(gpg_home, name))
+		except OSError:
+			continue
+		state.append([name, info.st_size, info.st_mtime_ns])
+	if not any(name in _keyring_files for name, size, mtime in state):
+		return None
+	return [os.path.abspath(gpg_home), state]
+
+def get_verification_cache(config):
+	max_entries = getattr(config, 'VERIFICATION_CACHE_SIZE', 1000)
+	if not max_entries:
+		return None
+	keyring_state = get_keyring_state()
+	if keyring_state is None:
+		return None		# (we wouldn't notice if the keyring changed)
+	trusted = config.CONTRIBUTOR_GPG_KEYS
+	context = json.dumps([sorted(trusted) if trusted is not None else None, keyring_state])
+	return VerificationCache(paths.get_cache_path('verified'), context, max_entries)
+
+_fingerprints = {}	# GPG_SIGNING_KEY -> signing key fingerprints
+
+def get_fingerprint(key):
+	"""Get the full fingerprints of the keys which gpg may use to sign with GPG_SIGNING_KEY:
+	the primary key and/or its subkeys, if they are capable of signing and not expired or revoked.
+	If there are several, gpg picks one, so the result identifies the whole set."""
+	if key not in _fingerprints:
+		stats.count('gpg processes')
+		keys = subprocess.check_output(['gpg', '--with-colons', '--fingerprint', '--fingerprint', '--list-secret-keys', key], encoding = 'utf-8')
+		found = False
+		signing_fprs = []
+		can_sign = False
+		for line in keys.split('\n'):
+			bits = line.split(':')
+			if bits[0] in ('sec', 'ssb'):
+				if bits[0] == 'sec' and found:
+					break		# Only use the first matching key, like gpg does
+				found = True
+				can_sign = 's' in bits[11] and bits[1] not in ('e', 'r')
+			elif bits[0] == 'fpr' and can_sign:
+				signing_fprs.append(bits[9])
+				can_sign = False
+		if not found:
+			raise SafeException("GPG key not found '{key}'".format(key = key))
+		if not signing_fprs:
+			raise SafeException("GPG key '{key}' has no usable signing key".format(key = key))
+		_fingerprints[key] = '+'.join(sorted(signing_fprs))
+	return _fingerprints[key]
+
+def get_signature_cache(config):
+	max_entries = getattr(config, 'SIGNATURE_CACHE_SIZE', 10000)
+	if not max_entries:
+		return None
+	return SignatureCache(paths.get_cache_path('signatures'), get_fingerprint(config.GPG_SIGNING_KEY), max_entries)
+
+def sign_all(config, documents):
+	"""Sign a list of (name, source_xml) pairs, returning the signed XML for each in the same order.
+	Up to config.SIGNING_JOBS gpg processes are run at once (default: 4). Documents we have signed
+	before are taken from the signature cache instead."""
+	if not config.GPG_SIGNING_KEY or not documents:
+		return [source_xml for name, source_xml in documents]
+
+	jobs = max(1, getattr(config, 'SIGNING_JOBS', 4))
+	cache = get_signature_cache(config)
+
+	signatures = [cache.lookup(source_xml) if cache else None for name, source_xml in documents]
+	to_sign = [i for i, signature in enumerate(signatures) if signature is None]
+	if len(to_sign) < len(documents):
+		logging.info("Reused %d cached signatures", len(documents) - len(to_sign))
+
+	def sign(source_xml):
+		start = time.time()
+		signature = build.detach_sign(config, source_xml)
+		return signature, time.time() - start
+
+	start = time.time()
+	with stats.phase('sign'), futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+		results = list(pool.map(sign, [documents[i][1] for i in to_sign]))
+	stats.count('signatures reused', len(documents) - len(to_sign))
+
+	latencies = []
+	for i, (signature, latency) in zip(to_sign, results):
+		logging.info("Signed %s in %.3fs", documents[i][0], latency)
+		latencies.append(latency)
+		signatures[i] = signature
+		if cache:
+			cache.add(documents[i][1], signature)
+
+	if len(to_sign) > 1:
+		slowest = max(range(len(to_sign)), key = lambda i: latencies[i])
+		print("Signed {n} files in {total:.1f}s using {jobs} gpg processes (mean {mean:.3f}s per file, slowest {max:.3f}s for {name})".format(
+			n = len(to_sign),
+			total = time.time() - start,
+			jobs = min(jobs, len(to_sign)),
+			mean = sum(latencies) / len(latencies),
+			max = latencies[slowest],
+			name = documents[to_sign[slowest]][0]))
+
+	if cache and to_sign:
+		cache.expire()
+
+	return [build.add_signature(source_xml, signature) for (name, source_xml), signature in zip(documents, signatures)]
@@ -0,0 +1,64 @@
+# Copyright (C) 2013, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+"""Timings and counters for the current run, reported by '0repo update --stats'."""
+
+import os, time, json, collections, contextlib
+
+from zeroinstall import SafeException, support
+
+phases = collections.OrderedDict()	# Name -> [calls, wall time, CPU time]
+counters = collections.Counter()	# Name -> count
+
+def _cpu_time():
+	# (includes the gpg and git processes we've waited for)
+	t = os.times()
+	return t.user + t.system + t.children_user + t.children_system
+
+@contextlib.contextmanager
+def phase(name):
+	"""Add the time spent inside this block to phase 'name'.
+	Phases may be nested (e.g. "incoming/digests" within "incoming")."""
+	start_wall = time.time()
+	start_cpu = _cpu_time()
+	try:
+		yield
+	finally:
+		totals = phases.setdefault(name, [0, 0.0, 0.0])
+		totals[0] += 1
+		totals[1] += time.time() - start_wall
+		totals[2] += _cpu_time() - start_cpu
+
+def count(name, n = 1):
+	counters[name] += n
+
+@contextlib.contextmanager
+def rejections(stage):
+	"""Count a SafeException raised inside this block as an incoming file rejected at 'stage'."""
+	try:
+		yield
+	except SafeException:
+		count('incoming rejected at ' + stage)
+		raise
+
+def reset():
+	phases.clear()
+	counters.clear()
+
+def report():
+	print("Phase                      Calls      Wall       CPU")
+	for name, (calls, wall, cpu) in phases.items():
+		print("{name:25s} {calls:6d} {wall:8.2f}s {cpu:8.2f}s".format(name = name, calls = calls, wall = wall, cpu = cpu))
+	for name, value in sorted(counters.items()):
+		print("{name}: {value}".format(name = name, value = value))
+
+def save(path):
+	"""Write the stats as JSON to 'path'."""
+	data = {
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'phases': {name: {'calls': calls, 'wall': wall, 'cpu': cpu} for name, (calls, wall, cpu) in phases.items()},
+		'counters': dict(counters),
+	}
+	with open(path + '.new', 'wt') as stream:
+		json.dump(data, stream, indent = 1, sort_keys = True)
+	support.portable_rename(path + '.new', path)
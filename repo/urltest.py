@@ -9,6 +9,8 @@ import ftplib
 
 from zeroinstall import SafeException
 
+from repo import stats
+
 def get_http_size(url, ttl = 3, method = None):
 	address = urllib.parse.urlparse(url)
 
@@ -31,6 +33,7 @@ def get_http_size(url, ttl = 3, method = None):
 		else:
 			method = 'HEAD'
 
+	stats.count('http requests')
 	http.request(method, '/' + path, headers = {'Host': address.hostname, 'User-agent': '0repo (http://0install.net/0repo.html)'})
 	response = http.getresponse()
 	try:
@@ -62,6 +65,7 @@ def get_http_size(url, ttl = 3, method = None):
 
 def get_ftp_size(url):
 	address = urllib.parse.urlparse(url)
+	stats.count('ftp requests')
 	ftp = ftplib.FTP(address.hostname)
 	try:
 		ftp.login()
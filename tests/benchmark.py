@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Time 0repo's commands on synthetic repositories of various sizes.
+
+Each run creates a fresh unsigned repository (as "0repo create DIR -" does) containing
+N feeds, each with M implementations spread over a few groups (with commands and
+<requires>) and K archives per implementation, then times update, add, modify,
+reindex and merging a new release into an existing feed.
+
+Results are written as JSON (one object per repository size), e.g.
+
+    python3 tests/benchmark.py --feeds 10,100,1000 --output bench.json
+
+and can be compared between commits.
+"""
+
+import argparse, json, os, sys, time, tempfile, shutil, subprocess, hashlib
+from io import StringIO
+from os.path import join, abspath, dirname
+
+mydir = dirname(abspath(__file__))
+sys.path.insert(0, dirname(mydir))
+
+from repo.cmd import main
+from repo import merge
+
+REPOSITORY_BASE_URL = "http://example.com/myrepo/"
+
+feed_template = """<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" uri="{uri}">
+  <name>{name}</name>
+  <summary>synthetic feed number {n}</summary>
+  <description>Generated by benchmark.py.</description>
+  <category>Development</category>
+{groups}
+</interface>
+"""
+
+group_template = """
+  <group license="OSI Approved :: GNU Lesser General Public License (LGPL)" arch="{arch}">
+    <command name="run" path="bin/{name}">
+      <runner interface="http://example.com/myrepo/runtime.xml"/>
+    </command>
+    <requires interface="http://example.com/myrepo/lib{lib}.xml" version="1..">
+      <environment insert="lib" name="LD_LIBRARY_PATH"/>
+    </requires>
+{impls}
+  </group>"""
+
+impl_template = """
+    <implementation id="sha1new={id}" released="2013-04-28" stability="stable" version="{version}">
+      <manifest-digest sha256new="{digest}"/>
+{archives}
+    </implementation>"""
+
+local_impl_template = """<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>{name}</name>
+  <summary>synthetic feed number {n}</summary>
+  <feed-for interface="{uri}"/>
+  <group license="OSI Approved :: GNU Lesser General Public License (LGPL)" arch="*-*">
+    <command name="run" path="bin/{name}"/>
+    <implementation id="sha1new={id}" released="2013-04-28" stability="stable" version="{version}">
+      <manifest-digest sha256new="{digest}"/>
+      <archive href="{archive}" size="{size}"/>
+    </implementation>
+  </group>
+</interface>
+"""
+
+archs = ['Linux-x86_64', 'Linux-i486', 'Windows-x86_64', 'MacOSX-x86_64']
+
+def run_repo(args):
+	oldcwd = os.getcwd()
+	old_stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		sys.stdin = StringIO('\n' * 100)
+		main(['0repo'] + args)
+	finally:
+		os.chdir(oldcwd)
+		sys.stdout = old_stdout
+
+def timed(results, name, fn, *args):
+	start = time.time()
+	fn(*args)
+	results[name] = round(time.time() - start, 4)
+
+def fake_id(*parts):
+	return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def create_repository(path, n_feeds, n_impls, n_archives):
+	run_repo(['create', path, '-'])
+	os.chdir(path)
+
+	with open('0repo-config.py') as stream:
+		config = stream.read()
+	config = config.replace('input("Press Return when done (edit 0repo-config.py:upload_public_dir() to automate this)")', 'pass')
+	config = config.replace('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")', 'return')
+	config += "\nCHECK_DIGESTS = False\nTRACK_TESTING_IMPLS = False\n"
+	config += "def check_uploaded_archive(archive, url): pass\n"
+	with open('0repo-config.py', 'wt') as stream:
+		stream.write(config)
+
+	os.makedirs('archive-backups')
+	with open('archives.db', 'at') as db:
+		for n in range(n_feeds):
+			name = 'prog%d' % n
+			rel_path = 'dir%d/%s.xml' % (n % 10, name)
+			groups = []
+			for g, arch in enumerate(archs):
+				impls = []
+				for i in range(g, n_impls, len(archs)):
+					archives = []
+					for k in range(n_archives):
+						basename = '%s-%d-%d.tar.gz' % (name, i, k)
+						with open(join('archive-backups', basename), 'wb') as stream:
+							stream.write(basename.encode())
+						sha1 = hashlib.sha1(basename.encode()).hexdigest()
+						db.write('%s %s %s\n' % (basename, sha1, REPOSITORY_BASE_URL + 'archives/' + basename))
+						archives.append('      <archive href="%s" size="%d"/>' % (basename, len(basename)))
+					impls.append(impl_template.format(id = fake_id(name, i), version = '1.%d' % i,
+							digest = fake_id(name, i, 'digest').upper(), archives = '\n'.join(archives)))
+				groups.append(group_template.format(arch = arch, name = name, lib = n % 7, impls = ''.join(impls)))
+			os.makedirs(join('feeds', dirname(rel_path)), exist_ok = True)
+			with open(join('feeds', rel_path), 'wt') as stream:
+				stream.write(feed_template.format(uri = REPOSITORY_BASE_URL + rel_path, name = name, n = n, groups = ''.join(groups)))
+
+	subprocess.check_call(['git', 'add', '.'], cwd = 'feeds')
+	subprocess.check_call(['git', 'commit', '-q', '-m', 'Synthetic feeds'], cwd = 'feeds')
+
+def new_release(n, version):
+	"""Write a new release of feed 'n' (and its archive) to 'incoming'."""
+	name = 'prog%d' % n
+	archive = '%s-%s.tar.gz' % (name, version)
+	with open(join('incoming', archive), 'wb') as stream:
+		stream.write(archive.encode())
+	path = join('incoming', '%s-%s.xml' % (name, version))
+	with open(path, 'wt') as stream:
+		stream.write(local_impl_template.format(name = name, n = n,
+				uri = REPOSITORY_BASE_URL + 'dir%d/%s.xml' % (n % 10, name),
+				id = fake_id(name, version), version = version,
+				digest = fake_id(name, version, 'digest').upper(),
+				archive = archive, size = len(archive)))
+	return abspath(path)
+
+def benchmark(n_feeds, n_impls, n_archives, jobs):
+	results = {}
+	tmpdir = tempfile.mkdtemp('-0repo-bench')
+	oldcwd = os.getcwd()
+	try:
+		path = join(tmpdir, 'repo')
+		timed(results, 'create', create_repository, path, n_feeds, n_impls, n_archives)
+
+		update = ['update'] + (['-j', str(jobs)] if jobs > 1 else [])
+		timed(results, 'update (initial)', run_repo, update)
+		timed(results, 'update (no changes)', run_repo, update)
+		timed(results, 'update --full', run_repo, update + ['--full'])
+
+		new_release(0, '2.0')
+		timed(results, 'update (one new release)', run_repo, update)
+
+		release = new_release(1, '2.0')
+		timed(results, 'add', run_repo, ['add', release])
+
+		timed(results, 'modify', run_repo, ['modify', REPOSITORY_BASE_URL + 'dir2/prog2.xml', '1.0', '--stability=buggy'])
+
+		timed(results, 'reindex', run_repo, ['reindex'])
+
+		release = new_release(3, '3.0')
+		feed = join('feeds', 'dir3', 'prog3.xml')
+		timed(results, 'merge', merge.merge_files, REPOSITORY_BASE_URL + 'dir3/prog3.xml', feed, release)
+	finally:
+		os.chdir(oldcwd)
+		shutil.rmtree(tmpdir)
+
+	return {
+		'feeds': n_feeds,
+		'implementations': n_impls,
+		'archives': n_archives,
+		'jobs': jobs,
+		'seconds': results,
+	}
+
+def get_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = mydir, encoding = 'utf-8').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Benchmark 0repo on synthetic repositories.')
+	parser.add_argument('--feeds', help = 'comma-separated list of repository sizes to try (default: 10,100)', default = '10,100')
+	parser.add_argument('--impls', help = 'implementations per feed (default: 8)', type = int, default = 8)
+	parser.add_argument('--archives', help = 'archives per implementation (default: 1)', type = int, default = 1)
+	parser.add_argument('-j', '--jobs', help = "pass -j N to '0repo update'", type = int, default = 1)
+	parser.add_argument('--output', metavar = 'FILE', help = 'write the results here instead of stdout')
+	args = parser.parse_args()
+
+	os.environ['NO_SIGN'] = '1'
+	os.environ['http_proxy'] = 'http://localhost:9999/bug'
+
+	runs = []
+	for n_feeds in [int(x) for x in args.feeds.split(',')]:
+		print("Benchmarking {n} feeds...".format(n = n_feeds), file = sys.stderr)
+		runs.append(benchmark(n_feeds, args.impls, args.archives, args.jobs))
+
+	report = {
+		'commit': get_commit(),
+		'python': sys.version.split()[0],
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'runs': runs,
+	}
+	if args.output:
+		with open(args.output, 'wt') as stream:
+			json.dump(report, stream, indent = 1)
+	else:
+		json.dump(report, sys.stdout, indent = 1)
+		print()
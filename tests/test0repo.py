@@ -2,10 +2,10 @@ import unittest
 import tempfile
 import shutil
 import subprocess
-import os, sys
+import os, sys, json
 import importlib
 import builtins
-from io import StringIO
+from io import StringIO, BytesIO
 
 from os.path import join
 
@@ -21,7 +21,7 @@ sys.path.insert(0, os.path.abspath('..'))
 test_gpghome = join(mydir, 'test-gpghome')
 
 from repo.cmd import main
-from repo import archives, registry, paths, urltest
+from repo import archives, registry, paths, urltest, stats
 
 responses = {}		# Path -> Response
 
@@ -103,6 +103,56 @@ def test_invalid(xml):
 	except SafeException as ex:
 		return str(ex)
 
+def read_public_files():
+	"""Relative path -> contents of each file in 'public', without any signatures (which include the time)."""
+	files = {}
+	for dirpath, dirnames, filenames in os.walk('public'):
+		for name in filenames:
+			path = join(dirpath, name)
+			with open(path, 'rb') as stream:
+				data = stream.read()
+			sig_index = data.rfind(b'\n<!-- Base64 Signature')
+			if sig_index != -1:
+				data = data[:sig_index]
+			files[os.path.relpath(path, 'public')] = data
+	return files
+
+def remove_generated_files():
+	"""Delete the feeds and catalogs from 'public', so that the next 'update --full' writes them all again."""
+	for rel_path in read_public_files():
+		if rel_path.endswith(('.xml', '.json')):
+			os.unlink(join('public', rel_path))
+
+# A feed edited by hand (so not reformatted by 0repo), with comments, CDATA and a recipe in a nested group
+extra_feed = """<?xml version="1.0"?>
+<!-- Maintained by hand -->
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" uri="http://example.com/myrepo/{path}">
+  <name>extra</name>
+  <summary>extra &amp; more</summary>
+  <description><![CDATA[Uses <b>markup</b> & "quotes"]]></description>
+
+  <!-- Releases -->
+  <group license='Example only' released='2013-04-28'>
+    <group arch='*-*'>
+      <implementation id="extra1" version="1">
+	<manifest-digest sha256new='PGUFCJE7VW7LFX45BUNOL4UHABUL5I6GYNFKQ4ENOLLLCMHID2IA'/>
+	<recipe>
+	  <archive href="{archive}" size="185"/>
+	  <rename source='HelloWorld/main' dest='prog'/>
+	</recipe>
+      </implementation>
+    </group>
+  </group>
+</interface>
+"""
+
+def write_extra_feed(rel_path, archive = 'test-2.tar.bz2'):
+	path = join('feeds', rel_path)
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wt') as stream:
+		stream.write(extra_feed.format(path = rel_path, archive = archive))
+
 class Test0Repo(unittest.TestCase):
 	def setUp(self):
 		self.tmpdir = tempfile.mkdtemp('-0repo')
@@ -171,6 +221,12 @@ class Test0Repo(unittest.TestCase):
 		self.assertEqual(XMLNS_IFACE, feed.uri)
 		self.assertEqual("http://example.com/myrepo/tests/test.xml", feed.attrs['uri'])
 
+		with open(join('public', 'catalog.json'), 'rt') as stream:
+			index = json.load(stream)
+		self.assertEqual(1, index['count'])
+		self.assertEqual([], index['chunks'])
+		self.assertEqual("http://example.com/myrepo/tests/test.xml", index['items'][0]['uri'])
+
 		# Check invalid archives are rejected
 		with open(join(mydir, 'test-2.xml'), 'rt') as stream:
 			test2_orig = stream.read()
@@ -346,6 +402,395 @@ class Test0Repo(unittest.TestCase):
 		out = run_repo(['update'])
 		assert 'Updated public/tests/test.xml' in out, out
 
+		out = run_repo(['update', '--stats'])
+		assert 'feeds skipped as unchanged: 1' in out, out
+		assert 'Saved stats as ' in out, out
+
+	def testUncommittedChanges(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+
+		responses['/downloads/test-1.tar.bz2'] = FakeResponse(419419)
+		out = run_repo(['add', join(mydir, 'test-1.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+
+		with open(join('feeds', 'tests', 'test.xml'), 'at') as stream:
+			stream.write('<!-- edited by hand -->\n')
+
+		try:
+			run_repo(['add', join(mydir, 'test-2.xml')])
+			assert 0, 'Not rejected'
+		except SafeException as ex:
+			assert 'Uncommitted changes in' in str(ex), ex
+			assert 'edited by hand' in str(ex), ex
+
+		out = run_repo(['update'])
+		assert 'Note: you have uncommitted changes in' in out, out
+		assert ' M tests/test.xml' in out, out
+
+	def testAlreadyMerged(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+
+		# Import A, then B into the same feed
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), join('incoming', 'test-2.tar.bz2'))
+		shutil.copyfile(join(mydir, 'test-2.xml'), join('incoming', 'test-2.xml'))
+		out = run_repo([])
+		assert 'Updated public/tests/test.xml' in out, out
+
+		responses['/downloads/test-1.tar.bz2'] = FakeResponse(419419)
+		shutil.copyfile(join(mydir, 'test-1.xml'), join('incoming', 'test-1.xml'))
+		out = run_repo([])
+		assert 'Updated public/tests/test.xml' in out, out
+
+		# Resubmit A (its archive has already been moved out of incoming)
+		shutil.copyfile(join(mydir, 'test-2.xml'), join('incoming', 'test-2.xml'))
+		out = run_repo([])
+		assert 'Already merged this into feeds/tests/test.xml (in commit ' in out, out
+
+	def testBatchRollback(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+		update_config('#BATCH_COMMITS = True', 'BATCH_COMMITS = True')
+
+		responses['/downloads/test-1.tar.bz2'] = FakeResponse(419419)
+		out = run_repo(['add', join(mydir, 'test-1.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = 'feeds')
+
+		with open(join(mydir, 'test-2.xml'), 'rt') as stream:
+			test2_orig = stream.read()
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), join('incoming', 'test-2.tar.bz2'))
+		# A new feed...
+		with open(join('incoming', 'a.xml'), 'wt') as stream:
+			stream.write(test2_orig.replace('tests/test.xml', 'tests/other.xml'))
+		# ... and an update to the existing one, which fails
+		with open(join('incoming', 'b.xml'), 'wt') as stream:
+			stream.write(test2_orig.replace("sha256new='RPUJPV", "sha256new='RPV"))
+
+		try:
+			run_repo([])
+			assert 0, 'Not rejected'
+		except SafeException as ex:
+			assert 'Incorrect manifest -- archive is corrupted' in str(ex), ex
+
+		self.assertEqual(b'', subprocess.check_output(['git', 'status', '--porcelain'], cwd = 'feeds'))
+		self.assertEqual(head, subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = 'feeds'))
+		assert not os.path.exists(join('feeds', 'tests', 'other.xml'))
+		assert os.path.exists(join('incoming', 'a.xml'))
+
+	def testCompress(self):
+		import gzip
+		from repo.cmd import proxy
+
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+		update_config("#COMPRESS_PUBLIC_FILES = ['gz', 'br']", "COMPRESS_PUBLIC_FILES = ['gz']")
+
+		def check_gz(rel_path):
+			path = join('public', rel_path)
+			with open(path, 'rb') as stream:
+				data = stream.read()
+			with gzip.open(path + '.gz', 'rb') as stream:
+				self.assertEqual(data, stream.read())
+			assert not os.path.exists(path + '.br')
+			return data
+
+		out = run_repo(['add', join(mydir, 'test-2.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		old_feed = check_gz(join('tests', 'test.xml'))
+		check_gz('catalog.xml')
+		check_gz('catalog.json')
+
+		# Changing the feed regenerates its compressed copy
+		responses['/downloads/test-1.tar.bz2'] = FakeResponse(419419)
+		out = run_repo(['add', join(mydir, 'test-1.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		self.assertNotEqual(old_feed, check_gz(join('tests', 'test.xml')))
+
+		# The proxy only sends fresh variants of feeds and catalogs
+		os.chdir('public')
+		self.assertEqual(['gz'], proxy.preferred_extensions('gzip, deflate'))
+		self.assertEqual([], proxy.preferred_extensions('gzip;q=0, deflate'))
+		self.assertEqual('gz', proxy.pick_variant('tests/test.xml', 'gzip'))
+		self.assertEqual(None, proxy.pick_variant('tests/test.xml', 'br'))
+		self.assertEqual(None, proxy.pick_variant('tests/test.xml', ''))
+		self.assertEqual(None, proxy.pick_variant('tests/test.xml.gz', 'gzip'))
+		stat = os.stat('tests/test.xml')
+		os.utime('tests/test.xml.gz', ns = (stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+		self.assertEqual(None, proxy.pick_variant('tests/test.xml', 'gzip'))
+		os.chdir('..')
+
+		# Unconfigured variants are removed
+		update_config("COMPRESS_PUBLIC_FILES = ['gz']", "COMPRESS_PUBLIC_FILES = []")
+		run_repo(['update'])
+		for rel_path in [join('tests', 'test.xml'), 'catalog.xml', 'catalog.json']:
+			assert not os.path.exists(join('public', rel_path + '.gz')), rel_path
+
+	def testStreamingFeeds(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+
+		out = run_repo(['add', join(mydir, 'test-2.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		out = run_repo(['add', join(mydir, 'test-4.xml')], stdin = 'n\n')
+		assert 'Updated public/tests/test.xml' in out, out
+		write_extra_feed('extra/extra.xml')
+		out = run_repo(['update', '-j', '1'])
+		assert 'Updated public/extra/extra.xml' in out, out
+		expected = read_public_files()
+
+		# Generating everything again without building DOMs gives the same files
+		update_config('#STREAMING_FEED_SIZE = 1024 * 1024', 'STREAMING_FEED_SIZE = 0')
+		remove_generated_files()
+		stats.reset()
+		out = run_repo(['update', '--full', '-j', '1', '--stats'])
+		assert 'feeds streamed: 2' in out, out
+		self.assertEqual(sorted(expected), sorted(read_public_files()))
+		self.assertEqual(expected, read_public_files())
+
+	def testParallelBuild(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+
+		out = run_repo(['add', join(mydir, 'test-2.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		write_extra_feed('extra/extra.xml')
+		# (a worker can't import an archive, so it leaves this feed to the main process)
+		write_extra_feed('other/other.xml', archive = 'other.tar.bz2')
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), join('incoming', 'other.tar.bz2'))
+
+		out = run_repo(['update', '-j', '2'])
+		assert 'Importing missing archive other.tar.bz2' in out, out
+		assert 'Updated public/extra/extra.xml' in out, out
+		assert 'Updated public/other/other.xml' in out, out
+		assert not os.path.exists(join('incoming', 'other.tar.bz2'))
+		expected = read_public_files()
+
+		# Generating everything again in this process gives the same files
+		remove_generated_files()
+		run_repo(['update', '--full', '-j', '1'])
+		self.assertEqual(sorted(expected), sorted(read_public_files()))
+		self.assertEqual(expected, read_public_files())
+
+	def testCatalogState(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+
+		out = run_repo(['add', join(mydir, 'test-2.xml')])
+		assert 'Updated public/tests/catalog.xml' in out, out
+		write_extra_feed('extra/a.xml')
+		write_extra_feed('extra/b.xml')
+		out = run_repo(['update'])
+		assert 'Updated public/extra/catalog.xml' in out, out
+		assert 'Updated public/catalog.xml' in out, out
+
+		# Nothing changed
+		stats.reset()
+		out = run_repo(['update', '--stats'])
+		assert 'catalogs skipped as unchanged: 3' in out, out
+		assert 'Updated ' not in out, out
+
+		# Changing a feed only regenerates its directory's catalog and the root one
+		with open(join('feeds', 'extra', 'a.xml'), 'rt') as stream:
+			data = stream.read()
+		with open(join('feeds', 'extra', 'a.xml'), 'wt') as stream:
+			stream.write(data.replace('<summary>extra &amp; more</summary>', '<summary>changed</summary>'))
+		stats.reset()
+		out = run_repo(['update', '--stats'])
+		assert 'Updated public/extra/a.xml' in out, out
+		assert 'Updated public/extra/catalog.xml' in out, out
+		assert 'Updated public/catalog.xml' in out, out
+		assert 'Updated public/tests/catalog.xml' not in out, out
+		assert 'catalogs skipped as unchanged: 1' in out, out
+		with open(join('public', 'extra', 'catalog.xml'), 'rt') as stream:
+			assert '>changed<' in stream.read()
+
+		# So does removing one
+		os.unlink(join('feeds', 'extra', 'b.xml'))
+		out = run_repo(['update'])
+		assert 'Updated public/extra/catalog.xml' in out, out
+		assert 'Updated public/catalog.xml' in out, out
+		assert 'Updated public/tests/catalog.xml' not in out, out
+		with open(join('public', 'extra', 'catalog.xml'), 'rt') as stream:
+			assert 'http://example.com/myrepo/extra/b.xml' not in stream.read()
+
+	def testCatalogShards(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+		update_config("#CATALOG_SHARDS = 'directory'", "CATALOG_SHARDS = 'directory'")
+
+		out = run_repo(['add', join(mydir, 'test-2.xml')])
+		assert 'Updated public/tests/test.xml' in out, out
+		write_extra_feed('extra/extra.xml')
+		os.makedirs(join('public', 'catalog-shards'))
+		with open(join('public', 'catalog-shards', 'README'), 'wt') as stream:
+			stream.write('Not generated by 0repo\n')
+		out = run_repo(['update'])
+		assert 'Updated public/catalog-shards/extra.xml' in out, out
+
+		# The root catalog just lists the shards
+		with open(join('public', 'catalog.xml'), 'rb') as stream:
+			root = qdom.parse(stream)
+		self.assertEqual(['catalog-shards/extra.xml', 'catalog-shards/tests.xml'],
+				 [child.attrs['href'] for child in root.childNodes if child.name == 'shard'])
+		self.assertEqual([], [child for child in root.childNodes if child.name == 'interface'])
+
+		for key, uri in [('tests', 'http://example.com/myrepo/tests/test.xml'),
+				 ('extra', 'http://example.com/myrepo/extra/extra.xml')]:
+			with open(join('public', 'catalog-shards', key + '.xml'), 'rb') as stream:
+				shard = qdom.parse(stream)
+			self.assertEqual([uri], [child.attrs['uri'] for child in shard.childNodes if child.name == 'interface'])
+
+		with open(join('public', 'catalog.json'), 'rt') as stream:
+			index = json.load(stream)
+		self.assertEqual(2, index['count'])
+		self.assertEqual(['catalog-shards/extra.json', 'catalog-shards/tests.json'], index['chunks'])
+		for chunk in index['chunks']:
+			assert os.path.exists(join('public', chunk)), chunk
+
+		# Turning sharding off removes the shards, but nothing else in their directory
+		update_config("CATALOG_SHARDS = 'directory'", "CATALOG_SHARDS = None")
+		out = run_repo(['update'])
+		assert 'Removed old catalog shard public/catalog-shards/tests.xml' in out, out
+		self.assertEqual(['README'], os.listdir(join('public', 'catalog-shards')))
+		with open(join('public', 'catalog.xml'), 'rb') as stream:
+			root = qdom.parse(stream)
+		self.assertEqual(['http://example.com/myrepo/extra/extra.xml', 'http://example.com/myrepo/tests/test.xml'],
+				 sorted(child.attrs['uri'] for child in root.childNodes if child.name == 'interface'))
+
+	def testVerificationCache(self):
+		out = run_repo(['create', 'my-repo', 'Test Key for 0repo'])
+		assert not out
+		os.chdir('my-repo')
+		update_config('raise Exception("No upload method specified: edit upload_archives() in 0repo-config.py")',
+				'return test0repo.upload(archives)')
+		update_config('CONTRIBUTOR_GPG_KEYS = None', 'CONTRIBUTOR_GPG_KEYS = {"3F52282D484EB9401EE3A66A6D66BDF4F467A18D"}')
+
+		responses['/imported-1.tar.bz2'] = FakeResponse(200)
+		stats.reset()
+		run_repo(['add', join(mydir, 'imported.xml')])
+		assert os.path.exists(join('public', 'tests', 'imported.xml'))
+		assert 'incoming/signatures' in stats.phases
+		self.assertEqual(0, stats.counters['signature checks reused'])
+
+		# Checking the same file again doesn't need gpg
+		stats.reset()
+		out = run_repo(['add', join(mydir, 'imported.xml')])
+		assert 'Already imported feeds/tests/imported.xml; skipping' in out, out
+		assert 'incoming/signatures' not in stats.phases
+		self.assertEqual(1, stats.counters['signature checks reused'])
+
+		# Changing the trusted keys invalidates the entry
+		update_config('CONTRIBUTOR_GPG_KEYS = {"3F52282D484EB9401EE3A66A6D66BDF4F467A18D"}', 'CONTRIBUTOR_GPG_KEYS = set()')
+		stats.reset()
+		try:
+			run_repo(['add', join(mydir, 'imported.xml')])
+			assert 0, 'Not rejected'
+		except SafeException as ex:
+			assert 'No trusted signatures on feed' in str(ex), ex
+		assert 'incoming/signatures' in stats.phases
+		self.assertEqual(0, stats.counters['signature checks reused'])
+
+	def testStreamDigests(self):
+		import tarfile, zipfile, struct
+		from zeroinstall.zerostore import manifest, unpack
+
+		def make_recipe(path, extract = None, dest = None):
+			recipe = model.Recipe()
+			recipe.steps.append(model.DownloadSource(None, url = path, size = os.path.getsize(path), extract = extract, dest = dest))
+			return recipe
+
+		def unpacked_digest(path, alg_name, extract = None, dest = None):
+			tmpdir = tempfile.mkdtemp(dir = self.tmpdir)
+			target = join(tmpdir, dest) if dest else tmpdir
+			os.makedirs(target, exist_ok = True)
+			with open(path, 'rb') as stream:
+				unpack.unpack_archive(path, stream, target, extract = extract)
+			alg = manifest.get_algorithm(alg_name)
+			return alg.getID(manifest.add_manifest_file(tmpdir, alg))
+
+		tarball = join(mydir, 'test-2.tar.bz2')
+		self.assertEqual('sha256new_RPUJPVVHEWJ673N736OCN7EMESYAEYM2UAY6OJ4MDFGUZ7QACLKA',
+				archives.stream_manifest_digest(make_recipe(tarball), 'sha256new'))
+
+		# A zip archive with a sub-directory, an executable and a symlink
+		zip_path = join(self.tmpdir, 'test.zip')
+		with zipfile.ZipFile(zip_path, 'w') as archive:
+			for name, mode, data in [('top/', 0o40755, b''),
+						 ('top/bin/', 0o40755, b''),
+						 ('top/bin/run', 0o100755, b'#!/bin/sh\n'),
+						 ('top/README', 0o100644, b'Hello\n'),
+						 ('top/link', 0o120777, b'bin/run')]:
+				info = zipfile.ZipInfo(name, (2014, 1, 2, 3, 4, 6))
+				info.create_system = 3
+				info.external_attr = mode << 16
+				info.extra = struct.pack('<HHBi', 0x5455, 5, 1, 1388631846)
+				archive.writestr(info, data)
+
+		for alg in ['sha1new', 'sha256', 'sha256new']:
+			for path, extract, dest in [(tarball, None, None),
+						    (tarball, 'HelloWorld', None),
+						    (tarball, 'HelloWorld', 'sub/dir'),
+						    (zip_path, None, None),
+						    (zip_path, 'top', None),
+						    (zip_path, 'top/bin', 'sub')]:
+				expected = unpacked_digest(path, alg, extract, dest)
+				recipe = make_recipe(path, extract = extract, dest = dest)
+				self.assertEqual(expected, archives.stream_manifest_digest(recipe, alg))
+				assert archives.stream_digest_matches(recipe, expected)
+				assert not archives.stream_digest_matches(recipe, expected[:-4] + 'AAAA')
+
+		# Anything unusual is left to the fetcher
+		def make_tar(name, members):
+			path = join(self.tmpdir, name)
+			with tarfile.open(path, 'w') as archive:
+				for info in members:
+					data = b'data'
+					if info.isreg():
+						info.size = len(data)
+					archive.addfile(info, BytesIO(data) if info.isreg() else None)
+			return path
+
+		def member(name, type = tarfile.REGTYPE, linkname = ''):
+			info = tarfile.TarInfo(name)
+			info.type = type
+			info.linkname = linkname
+			return info
+
+		for path in [make_tar('hardlink.tar', [member('a'), member('b', tarfile.LNKTYPE, 'a')]),
+			     make_tar('parent.tar', [member('../a')]),
+			     make_tar('absolute.tar', [member('/a')]),
+			     make_tar('duplicate.tar', [member('a'), member('./a')])]:
+			recipe = make_recipe(path)
+			with self.assertRaises(archives._Unsupported):
+				archives.stream_manifest_digest(recipe, 'sha256new')
+			assert not archives.stream_digest_matches(recipe, 'sha256new_RPUJPVVHEWJ673N736OCN7EMESYAEYM2UAY6OJ4MDFGUZ7QACLKA')
+
 	def testGrouping(self):
 		a = archives.Archive('/tmp/a.tgz', 'a.tgz', 0)
 		b = archives.Archive('/tmp/b.tgz', 'foo/sub/b.tgz', 0)
@@ -355,5 +800,110 @@ class Test0Repo(unittest.TestCase):
 		self.assertEqual(['/tmp/a.tgz'], sorted(groups['']))
 		self.assertEqual(['/tmp/b.tgz', '/tmp/c.tgz'], sorted(groups['foo/sub']))
 
+	def testDigestCache(self):
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), 'test-2.tar.bz2')
+		with open(join(mydir, 'test-2.xml'), 'rt') as stream:
+			test2_orig = stream.read()
+
+		class config:
+			digest_cache = archives.DigestCache('verified-digests')
+
+		def get_method(xml):
+			feed = model.ZeroInstallFeed(qdom.parse(BytesIO(xml.encode('utf-8'))))
+			impl = feed.implementations['version2']
+			return archives.IncomingMethod(self.tmpdir, impl, impl.download_sources[0], archives.pick_digest(impl))
+
+		method = get_method(test2_orig)
+		assert not method.is_verified(config)
+		config.digest_cache.add(method.get_digest_key(config), method.required_digest)
+		assert get_method(test2_orig).is_verified(config)
+
+		# Unpacking the same archive differently gives a different key
+		assert not get_method(test2_orig.replace('size="185"', 'size="185" extract="test"')).is_verified(config)
+		assert not get_method(test2_orig.replace('size="185"', 'size="185" dest="sub"')).is_verified(config)
+
+		# A different archive with the same name
+		with open('test-2.tar.bz2', 'ab') as stream:
+			stream.write(b'!')
+		assert not get_method(test2_orig).is_verified(config)
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), 'test-2.tar.bz2')
+
+		# Entries are kept on disk
+		config.digest_cache = archives.DigestCache('verified-digests')
+		assert get_method(test2_orig).is_verified(config)
+
+	def testParallelDigests(self):
+		from zeroinstall.injector.config import load_config
+		shutil.copyfile(join(mydir, 'test-2.tar.bz2'), 'test-2.tar.bz2')
+		with open(join(mydir, 'test-2.xml'), 'rt') as stream:
+			test2_orig = stream.read()
+		# A second implementation using the same archive, with the wrong digest
+		xml = test2_orig.replace('  </group>', """    <implementation id="version3" version="3">
+      <manifest-digest sha256new='RPVVHEWJ673N736OCN7EMESYAEYM2UAY6OJ4MDFGUZ7QACLKA'/>
+      <archive href="test-2.tar.bz2" size="185"/>
+    </implementation>
+  </group>""")
+		feed = model.ZeroInstallFeed(qdom.parse(BytesIO(xml.encode('utf-8'))))
+		scratch_dir = join(self.tmpdir, 'scratch')
+
+		class config:
+			DIGEST_JOBS = 2
+			DIGEST_SCRATCH_DIR = scratch_dir
+			archive_db = archives.ArchiveDB('archives.db')
+			digest_cache = archives.DigestCache('verified-digests')
+			zconfig = load_config()
+
+		methods = archives.check_incoming_archives(config, self.tmpdir, feed)
+		self.assertEqual(['version2', 'version3'], [method.impl.id for method in methods])
+		try:
+			archives._check_digests(config, methods)
+			assert 0, 'Not rejected'
+		except SafeException as ex:
+			assert 'Incorrect manifest -- archive is corrupted' in str(ex), ex
+		assert os.path.isdir(scratch_dir)
+
+		# The workers recorded the good one
+		config.digest_cache = archives.DigestCache('verified-digests')
+		assert methods[0].is_verified(config)
+		assert not methods[1].is_verified(config)
+
+	def testHashCache(self):
+		import hashlib, time
+		def write(data, age = 10):
+			with open('a', 'wb') as stream:
+				stream.write(data)
+			mtime = time.time() - age
+			os.utime('a', (mtime, mtime))
+			return hashlib.sha1(data).hexdigest()
+
+		hash_cache = archives.HashCache('sha1-cache')
+		sha1 = write(b'hello')
+		stats.reset()
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(1, stats.counters['hash cache hits'])
+
+		# Entries are kept on disk
+		hash_cache = archives.HashCache('sha1-cache')
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(2, stats.counters['hash cache hits'])
+
+		# A different size, with the same mtime
+		sha1 = write(b'hello!')
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+
+		# A different mtime, with the same size
+		sha1 = write(b'jello!', age = 20)
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(2, stats.counters['hash cache hits'])
+
+		# Files changed very recently aren't cached, as they might change again within the same mtime
+		sha1 = write(b'hello?', age = 0)
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(sha1, hash_cache.get_sha1('a'))
+		self.assertEqual(2, stats.counters['hash cache hits'])
+		self.assertEqual(sha1, archives.HashCache('sha1-cache').get_sha1('a'))
+		self.assertEqual(2, stats.counters['hash cache hits'])
+
 if __name__ == '__main__':
 	unittest.main()